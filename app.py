@@ -1,40 +1,239 @@
 import os
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import time
+
+# Cold-start reference point: first served request is measured from here
+APP_IMPORT_STARTED = time.perf_counter()
+
+import logging
+import threading
 from datetime import datetime
 import psycopg2
 from psycopg2 import pool
-from flask import Flask, request, redirect
+from dotenv import load_dotenv
+from flask import Flask, Blueprint, request, redirect, g, abort, send_from_directory, has_request_context
 from apscheduler.schedulers.background import BackgroundScheduler
 import pytz
 import traceback
-from urllib.parse import quote_plus
+from datetime import timedelta
+from prometheus_client import REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from structured_logging import setup_logging, new_request_id, request_id_var, run_id_var, dropped_records
+from metrics import HTTP_REQUEST_SECONDS, APP_COLD_START_SECONDS, DbPoolCollector, LogQueueCollector, PhaseTimer, observe_query
+from profiling import TOKEN_HEADER, SCHEDULER_TARGET, ADMIN_SESSION_TARGET, profiler_from_env
+from mailer import CircuitBreaker, EmailRenderer, SmtpTransport, mailbox_transport_from_spec
+from scheduling import (
+    SCHEDULER_LOCK_KEY, SCHEDULER_TABLES_DDL, TRY_LOCK_SQL, UNLOCK_SQL, UNFINISHED_RUNS_SQL,
+    INSERT_RUN_SQL, SENT_GROUPS_SQL, INSERT_LEDGER_SQL, ADVANCE_CHECKPOINT_SQL, PENDING_KPI_UPDATES_SQL,
+    SET_RUN_PHASE_SQL, DUE_KPIS_SQL, UPDATE_KPI_CREATED_AT_SQL, RECORD_KPI_UPDATE_SQL,
+    INSERT_RUN_HISTORY_SQL, RECENT_RUN_HISTORY_SQL, CLOSE_STALE_RUN_SQL,
+    get_current_iso_week, group_due_records, batch_plant_groups, batch_kpi_ids, render_batch,
+    percentile, resumable_run, RunTally,
+)
+
+load_dotenv()
 
-app = Flask(__name__)
+logger = logging.getLogger(__name__)
+
+# Routes live on a blueprint so nothing is built until create_app()
+bp = Blueprint('kpi', __name__)
 
 # ---------- Configuration ----------
 PORT = int(os.getenv('PORT', 5000))
 
+# Set SCHEDULER_ENABLED=false for web-only instances (or local runs) that
+# must never send the reminder emails
+SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
 # Power BI Dashboard URL
 POWER_BI_URL = "https://app.powerbi.com/groups/me/reports/9728953d-29c3-4009-99c6-3f61940eb937/b5462e0103e0e04ee51b?ctid=4e99b5ff-dd77-418a-8b69-1d684e911168&experience=power-bi"
 
 # ---------- PostgreSQL Connection Pool ----------
-db_pool = pool.SimpleConnectionPool(
-    1, 20,
-    user="administrationSTS",
-    host="avo-adb-002.postgres.database.azure.com",
-    database="Subsidy_DB",
-    password="St$@0987",
-    port=5432,
-    sslmode="require"
-)
+# Credentials come from the environment (.env locally, app settings on Azure).
+# The pool is opened by the first query, not at import.
+DB_HOST = os.getenv('DB_HOST')
+DB_PORT = int(os.getenv('DB_PORT', 5432))
+DB_NAME = os.getenv('DB_NAME')
+DB_USER = os.getenv('DB_USER')
+DB_PASSWORD = os.getenv('DB_PASSWORD')
+DB_SSLMODE = os.getenv('DB_SSLMODE', 'require')
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 20))
+
+# Optional streaming replica for pure reads (/form, /test-due-kpis,
+# get_all_kpi_values). The scheduler's due-KPI scan always reads the primary.
+# Without DB_READ_HOST everything reads from the primary. User, password and
+# port default to the primary's.
+DB_READ_HOST = os.getenv('DB_READ_HOST')
+DB_READ_PORT = int(os.getenv('DB_READ_PORT', DB_PORT))
+DB_READ_USER = os.getenv('DB_READ_USER', DB_USER)
+DB_READ_PASSWORD = os.getenv('DB_READ_PASSWORD', DB_PASSWORD)
+DB_READ_POOL_MAX = int(os.getenv('DB_READ_POOL_MAX', DB_POOL_MAX))
+DB_READ_CONNECT_TIMEOUT = int(os.getenv('DB_READ_CONNECT_TIMEOUT', 3))
+DB_READ_RETRY_SECONDS = 60
+
+# Read-your-writes: after a submit, the same browser reads from the primary
+# for this long so it never sees the replica's older copy of its own edits
+READ_YOUR_WRITES_SECONDS = int(os.getenv('DB_READ_YOUR_WRITES_SECONDS', 30))
+READ_YOUR_WRITES_COOKIE = 'kpi_wrote_at'
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+_read_db_pool = None
+_read_db_pool_lock = threading.Lock()
+_read_db_pool_failed_at = None
+
+REGISTRY.register(DbPoolCollector({'primary': lambda: _db_pool, 'replica': lambda: _read_db_pool}))
+REGISTRY.register(LogQueueCollector(dropped_records))
 
 # ---------- Email Configuration ----------
-SMTP_SERVER = "avocarbon-com.mail.protection.outlook.com"
-SMTP_PORT = 25
-EMAIL_USER = "administration.STS@avocarbon.com"
-EMAIL_PASSWORD = "shnlgdyfbcztbhxn"
+SMTP_SERVER = os.getenv('EMAIL_HOST', 'avocarbon-com.mail.protection.outlook.com')
+SMTP_PORT = int(os.getenv('EMAIL_PORT', 25))
+EMAIL_USER = os.getenv('EMAIL_USER', 'administration.STS@avocarbon.com')
+EMAIL_PASSWORD = os.getenv('EMAIL_PASS')
+
+# Open the SMTP circuit after this many consecutive connection failures,
+# then probe the relay again every SMTP_BREAKER_RESET_SECONDS
+SMTP_BREAKER_THRESHOLD = int(os.getenv('SMTP_BREAKER_THRESHOLD', 3))
+SMTP_BREAKER_RESET_SECONDS = int(os.getenv('SMTP_BREAKER_RESET_SECONDS', 300))
+
+smtp_breaker = CircuitBreaker(SMTP_BREAKER_THRESHOLD, SMTP_BREAKER_RESET_SECONDS)
+
+# An unfinished run is resumed only within this many hours of its start and
+# in the same ISO week; older ones are closed so they can't swallow new sends
+SCHEDULER_RESUME_HOURS = int(os.getenv('SCHEDULER_RESUME_HOURS', 6))
+
+# Digest mode: one email per responsible covering all their due plants
+# instead of one email per (responsible, plant)
+EMAIL_DIGEST_MODE = os.getenv('EMAIL_DIGEST_MODE', 'false').lower() in ('1', 'true', 'yes')
+
+# Render-only mode: "maildir:/path" or "mbox:/path" writes reminders to a local
+# mailbox instead of the relay, and scheduler runs record no ledger or KPI updates
+EMAIL_RENDER_ONLY = os.getenv('EMAIL_RENDER_ONLY')
+
+if EMAIL_RENDER_ONLY:
+    mail_transport = mailbox_transport_from_spec(EMAIL_RENDER_ONLY)
+else:
+    mail_transport = SmtpTransport(SMTP_SERVER, SMTP_PORT, smtp_breaker)
+
+# Opt-in profiling (PROFILING_ENABLED + PROFILING_SECRET, see profiling.py), set
+# up by create_app(). None when disabled: no request hooks or admin routes are registered.
+profiler = None
+
+scheduler = BackgroundScheduler(timezone=pytz.timezone('Africa/Tunis'))
+_scheduler_lock = threading.Lock()
+
+_cold_start_pending = True
+
+# ========================================
+# DATABASE POOL
+# ========================================
+
+def _open_pool(label, host, port, user, password, maxconn, **kwargs):
+    started = time.perf_counter()
+    opened = pool.ThreadedConnectionPool(
+        DB_POOL_MIN, maxconn,
+        user=user,
+        host=host,
+        database=DB_NAME,
+        password=password,
+        port=port,
+        sslmode=DB_SSLMODE,
+        **kwargs
+    )
+    logger.info("Database %s pool opened in %.0f ms", label, (time.perf_counter() - started) * 1000,
+                extra={'host': host, 'maxconn': maxconn})
+    return opened
+
+def get_db_pool():
+    """Shared connection pool to the primary, opened on first use"""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = _open_pool('primary', DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_POOL_MAX)
+    return _db_pool
+
+def _wrote_recently():
+    """True if this request, or this browser within READ_YOUR_WRITES_SECONDS, wrote to the primary"""
+    if not has_request_context():
+        return False
+    if g.get('wrote_primary'):
+        return True
+    wrote_at = request.cookies.get(READ_YOUR_WRITES_COOKIE, type=float)
+    return wrote_at is not None and time.time() - wrote_at < READ_YOUR_WRITES_SECONDS
+
+def get_read_db_pool():
+    """
+    Pool for read-only queries: the replica when DB_READ_HOST is set, otherwise
+    the primary. Also the primary right after this session wrote, or while the
+    replica is unreachable. Return connections to the pool this returned.
+    """
+    global _read_db_pool
+    if not DB_READ_HOST or _wrote_recently():
+        return get_db_pool()
+    if _read_db_pool_failed_at is not None and time.monotonic() - _read_db_pool_failed_at < DB_READ_RETRY_SECONDS:
+        return get_db_pool()
+    if _read_db_pool is None:
+        with _read_db_pool_lock:
+            if _read_db_pool is None:
+                try:
+                    _read_db_pool = _open_pool('replica', DB_READ_HOST, DB_READ_PORT, DB_READ_USER, DB_READ_PASSWORD,
+                                               DB_READ_POOL_MAX, connect_timeout=DB_READ_CONNECT_TIMEOUT)
+                except psycopg2.Error as e:
+                    _replica_failed(e)
+                    return get_db_pool()
+    return _read_db_pool
+
+def _replica_failed(e):
+    """Send reads to the primary for DB_READ_RETRY_SECONDS"""
+    global _read_db_pool_failed_at
+    _read_db_pool_failed_at = time.monotonic()
+    logger.warning("Read replica unavailable, reading from the primary for %ds: %s", DB_READ_RETRY_SECONDS, e)
+
+def run_read(query_name, fetch, primary=False):
+    """
+    Run fetch(cur) on a connection from get_read_db_pool() and return its result,
+    or on the primary when primary=True. A replica connection that fails with
+    OperationalError is closed and the read is retried once on the primary.
+    """
+    read_pool = get_db_pool() if primary else get_read_db_pool()
+    on_replica = read_pool is _read_db_pool
+    try:
+        conn = read_pool.getconn()
+    except psycopg2.OperationalError as e:
+        if not on_replica:
+            raise
+        _replica_failed(e)
+        return run_read(query_name, fetch, primary=True)
+
+    try:
+        with observe_query(query_name), conn.cursor() as cur:
+            return fetch(cur)
+    except psycopg2.OperationalError as e:
+        read_pool.putconn(conn, close=True)
+        conn = None
+        if not on_replica:
+            raise
+        _replica_failed(e)
+    finally:
+        if conn is not None:
+            read_pool.putconn(conn)
+    return run_read(query_name, fetch, primary=True)
+
+def mark_primary_write():
+    """Route this session's reads to the primary for READ_YOUR_WRITES_SECONDS"""
+    g.wrote_primary = True
+
+def close_db_pool():
+    """Close every pooled connection, if the pools were ever opened"""
+    global _db_pool, _read_db_pool
+    with _db_pool_lock:
+        if _db_pool is not None:
+            _db_pool.closeall()
+            _db_pool = None
+    with _read_db_pool_lock:
+        if _read_db_pool is not None:
+            _read_db_pool.closeall()
+            _read_db_pool = None
 
 # ========================================
 # HELPER FUNCTIONS
@@ -49,381 +248,757 @@ def _base_url():
         pass
     return os.getenv('APP_BASE_URL', 'https://kpi-subsidy.azurewebsites.net')
 
-def get_current_iso_week():
-    """Get current ISO week in format YYYY-Wxx (e.g., 2025-W43)"""
-    now = datetime.now()
-    iso_calendar = now.isocalendar()
-    return f"{iso_calendar[0]}-W{iso_calendar[1]:02d}"
-
 def get_responsible_with_kpis(responsible_id, week, plant_id=None):
     """Fetch responsible info and their KPIs for a given week and optionally a specific plant"""
-    conn = db_pool.getconn()
-    try:
-        with conn.cursor() as cur:
-            # Fetch responsible info with plant name
+    def fetch(cur):
+        # Fetch responsible info with plant name
+        cur.execute(
+            """
+            SELECT r.responsible_id, r.name, r.email, p.name as plant_name, p.plant_id
+            FROM public."Responsible" r
+            LEFT JOIN public.plants p ON r.plant_id = p.plant_id
+            WHERE r.responsible_id = %s
+            """,
+            (responsible_id,),
+        )
+        responsible = cur.fetchone()
+        if not responsible:
+            raise Exception("Responsible not found")
+
+        # Fetch KPIs - filter by plant_id if provided
+        if plant_id:
+            cur.execute(
+                """
+                SELECT kv.kpi_values_id, kv.value, kv.week, kv.analyse, kv.actions_correctives,
+                       k.kpi_id, k."KPI_name", k."KPI_objectif"
+                FROM public.kpi_values kv
+                JOIN public."Kpi" k ON kv.kpi_id = k.kpi_id
+                WHERE kv.responsible_id = %s AND kv.week = %s AND kv.plant_id = %s
+                ORDER BY k.kpi_id ASC
+                """,
+                (responsible_id, week, plant_id),
+            )
+        else:
             cur.execute(
                 """
-                SELECT r.responsible_id, r.name, r.email, p.name as plant_name, p.plant_id
-                FROM public."Responsible" r
-                LEFT JOIN public.plants p ON r.plant_id = p.plant_id
-                WHERE r.responsible_id = %s
+                SELECT kv.kpi_values_id, kv.value, kv.week, kv.analyse, kv.actions_correctives,
+                       k.kpi_id, k."KPI_name", k."KPI_objectif"
+                FROM public.kpi_values kv
+                JOIN public."Kpi" k ON kv.kpi_id = k.kpi_id
+                WHERE kv.responsible_id = %s AND kv.week = %s
+                ORDER BY k.kpi_id ASC
                 """,
-                (responsible_id,),
+                (responsible_id, week),
             )
-            responsible = cur.fetchone()
-            if not responsible:
-                raise Exception("Responsible not found")
+        kpis = cur.fetchall()
+
+        return {
+            'responsible': {
+                'responsible_id': responsible[0],
+                'name': responsible[1],
+                'email': responsible[2],
+                'plant_name': responsible[3] or 'N/A',
+                'plant_id': responsible[4],
+            },
+            'kpis': [
+                {
+                    'kpi_values_id': kpi[0],
+                    'value': kpi[1],
+                    'week': kpi[2],
+                    'analyse': kpi[3],
+                    'actions_correctives': kpi[4],
+                    'kpi_id': kpi[5],
+                    'KPI_name': kpi[6],
+                    'KPI_objectif': kpi[7],
+                }
+                for kpi in kpis
+            ],
+        }
 
-            # Fetch KPIs - filter by plant_id if provided
-            if plant_id:
-                cur.execute(
-                    """
-                    SELECT kv.kpi_values_id, kv.value, kv.week, kv.analyse, kv.actions_correctives,
-                           k.kpi_id, k."KPI_name", k."KPI_objectif"
-                    FROM public.kpi_values kv
-                    JOIN public."Kpi" k ON kv.kpi_id = k.kpi_id
-                    WHERE kv.responsible_id = %s AND kv.week = %s AND kv.plant_id = %s
-                    ORDER BY k.kpi_id ASC
-                    """,
-                    (responsible_id, week, plant_id),
-                )
-            else:
-                cur.execute(
-                    """
-                    SELECT kv.kpi_values_id, kv.value, kv.week, kv.analyse, kv.actions_correctives,
-                           k.kpi_id, k."KPI_name", k."KPI_objectif"
-                    FROM public.kpi_values kv
-                    JOIN public."Kpi" k ON kv.kpi_id = k.kpi_id
-                    WHERE kv.responsible_id = %s AND kv.week = %s
-                    ORDER BY k.kpi_id ASC
-                    """,
-                    (responsible_id, week),
-                )
-            kpis = cur.fetchall()
-
-            return {
-                'responsible': {
-                    'responsible_id': responsible[0],
-                    'name': responsible[1],
-                    'email': responsible[2],
-                    'plant_name': responsible[3] or 'N/A',
-                    'plant_id': responsible[4],
-                },
-                'kpis': [
-                    {
-                        'kpi_values_id': kpi[0],
-                        'value': kpi[1],
-                        'week': kpi[2],
-                        'analyse': kpi[3],
-                        'actions_correctives': kpi[4],
-                        'kpi_id': kpi[5],
-                        'KPI_name': kpi[6],
-                        'KPI_objectif': kpi[7],
-                    }
-                    for kpi in kpis
-                ],
+    try:
+        return run_read('get_responsible_with_kpis', fetch)
+    except Exception as e:
+        logger.error("Database error in get_responsible_with_kpis: %s", e)
+        raise
+
+def get_all_kpi_values():
+    """Fetch all KPI values with responsible, plant, and KPI details"""
+    def fetch(cur):
+        cur.execute(
+            """
+            SELECT 
+                kv.kpi_values_id,
+                r.responsible_id,
+                r.name as responsible_name,
+                p.name as plant_name,
+                k.kpi_id,
+                k."KPI_name",
+                kv.value,
+                kv.week,
+                kv.analyse,
+                kv.actions_correctives,
+                k."KPI_objectif"
+            FROM public.kpi_values kv
+            JOIN public."Responsible" r ON kv.responsible_id = r.responsible_id
+            LEFT JOIN public.plants p ON r.plant_id = p.plant_id
+            JOIN public."Kpi" k ON kv.kpi_id = k.kpi_id
+            ORDER BY kv.week DESC, r.name ASC, k."KPI_name" ASC
+            """
+        )
+        results = cur.fetchall()
+
+        return [
+            {
+                'kpi_values_id': row[0],
+                'responsible_id': row[1],
+                'responsible_name': row[2],
+                'plant_name': row[3] or 'N/A',
+                'kpi_id': row[4],
+                'kpi_name': row[5],
+                'value': row[6],
+                'week': row[7],
+                'analyse': row[8],
+                'actions_correctives': row[9],
+                'kpi_objectif': row[10]
             }
+            for row in results
+        ]
+
+    try:
+        return run_read('get_all_kpi_values', fetch)
+    except Exception as e:
+        logger.exception("Database error in get_all_kpi_values: %s", e)
+        return []
+
+def send_kpi_email(responsible_id, responsible_name, responsible_email, kpi_name, week, plant_name, plant_id, renderer=None):
+    """Send KPI email with a link to the form for a specific responsible and plant"""
+    try:
+        renderer = renderer or EmailRenderer(EMAIL_USER, _base_url())
+        msg = renderer.render_plant(responsible_id, responsible_name, responsible_email, kpi_name, week, plant_name, plant_id)
+
+        if mail_transport.send(msg):
+            logger.debug("Email sent", extra={'to': responsible_email, 'kpi': kpi_name, 'plant': plant_name})
+            return True
+        return False
+
     except Exception as e:
-        print(f"❌ Database error in get_responsible_with_kpis: {str(e)}")
+        logger.exception("Failed to send email to %s: %s", responsible_email, e)
+        return False
+
+# ========================================
+# SEND LEDGER & RUN CHECKPOINT
+# ========================================
+
+_scheduler_tables_ready = False
+
+def ensure_scheduler_tables():
+    """Create the run checkpoint and sent-ledger tables if they do not exist yet"""
+    global _scheduler_tables_ready
+    if _scheduler_tables_ready:
+        return
+
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    try:
+        with observe_query('ensure_scheduler_tables'), conn.cursor() as cur:
+            cur.execute(SCHEDULER_TABLES_DDL)
+        conn.commit()
+        _scheduler_tables_ready = True
+    except Exception:
+        conn.rollback()
         raise
     finally:
         db_pool.putconn(conn)
 
-def get_all_kpi_values():
-    """Fetch all KPI values with responsible, plant, and KPI details"""
+def acquire_scheduler_lock(db_pool):
+    """
+    Take the scheduler advisory lock on a dedicated connection from db_pool.
+    Returns the connection holding the lock, or None if another run holds it.
+    """
     conn = db_pool.getconn()
     try:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT 
-                    kv.kpi_values_id,
-                    r.responsible_id,
-                    r.name as responsible_name,
-                    p.name as plant_name,
-                    k.kpi_id,
-                    k."KPI_name",
-                    kv.value,
-                    kv.week,
-                    kv.analyse,
-                    kv.actions_correctives,
-                    k."KPI_objectif"
-                FROM public.kpi_values kv
-                JOIN public."Responsible" r ON kv.responsible_id = r.responsible_id
-                LEFT JOIN public.plants p ON r.plant_id = p.plant_id
-                JOIN public."Kpi" k ON kv.kpi_id = k.kpi_id
-                ORDER BY kv.week DESC, r.name ASC, k."KPI_name" ASC
-                """
-            )
-            results = cur.fetchall()
-            
-            return [
-                {
-                    'kpi_values_id': row[0],
-                    'responsible_id': row[1],
-                    'responsible_name': row[2],
-                    'plant_name': row[3] or 'N/A',
-                    'kpi_id': row[4],
-                    'kpi_name': row[5],
-                    'value': row[6],
-                    'week': row[7],
-                    'analyse': row[8],
-                    'actions_correctives': row[9],
-                    'kpi_objectif': row[10]
-                }
-                for row in results
-            ]
+        with observe_query('scheduler_lock'), conn.cursor() as cur:
+            cur.execute(TRY_LOCK_SQL, (SCHEDULER_LOCK_KEY,))
+            locked = cur.fetchone()[0]
+        # Session-level lock: commit so the connection does not sit idle in transaction
+        conn.commit()
+    except Exception:
+        db_pool.putconn(conn)
+        raise
+
+    if not locked:
+        db_pool.putconn(conn)
+        return None
+    return conn
+
+def release_scheduler_lock(db_pool, conn):
+    """Release the scheduler advisory lock and return its connection to db_pool"""
+    try:
+        with observe_query('scheduler_unlock'), conn.cursor() as cur:
+            cur.execute(UNLOCK_SQL, (SCHEDULER_LOCK_KEY,))
+        conn.commit()
     except Exception as e:
-        print(f"❌ Database error in get_all_kpi_values: {str(e)}")
-        traceback.print_exc()
-        return []
+        logger.warning("Failed to release scheduler lock: %s", e)
     finally:
         db_pool.putconn(conn)
 
-def send_kpi_email(responsible_id, responsible_name, responsible_email, kpi_name, week, plant_name, plant_id):
-    """Send KPI email with a link to the form for a specific responsible and plant"""
+def start_or_resume_run(week):
+    """
+    Resume the most recent unfinished run if it is for this week and started
+    within SCHEDULER_RESUME_HOURS; otherwise close stale runs and open a new one.
+    Returns: (run_id, run_week, groups_done, resumed)
+    """
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
     try:
-        base = _base_url()
-        form_link = f"{base}/form?responsible_id={responsible_id}&week={quote_plus(week)}&plant_id={plant_id}"
+        with observe_query('start_or_resume_run'), conn.cursor() as cur:
+            cur.execute(UNFINISHED_RUNS_SQL, (SCHEDULER_RESUME_HOURS,))
+            run, stale_runs = resumable_run(cur.fetchall(), week)
+        conn.commit()
+    finally:
+        db_pool.putconn(conn)
 
-        msg = MIMEMultipart()
-        msg['From'] = f'"Administration STS" <{EMAIL_USER}>'
-        msg['To'] = responsible_email
-        msg['Subject'] = f"KPI Report - {kpi_name} - {plant_name} - Week {week}"
+    for stale in stale_runs:
+        close_stale_run(stale[0])
+    if run:
+        return run[0], run[1], run[2], True
 
-        html_content = f"""
-        <!DOCTYPE html>
-        <html>
-        <body style="font-family:Arial,sans-serif; background:#f7f7f7; padding:24px;">
-          <div style="max-width:640px;margin:0 auto;background:#fff;border-radius:8px;overflow:hidden;border:1px solid #eee">
-            <div style="background:#0078D7;color:#fff;padding:20px 24px">
-              <h2 style="margin:0;font-weight:600">KPI Report – {responsible_name}</h2>
-              <div style="margin-top:8px;font-size:14px">Week {week} | {plant_name}</div>
-            </div>
-            <div style="padding:24px">
-              <p>Hello {responsible_name},</p>
-              <p>The KPI <strong>{kpi_name}</strong> for <strong>{plant_name}</strong> is due for reporting for week <strong>{week}</strong>.</p>
-              <p>Please click the link below to fill out your KPI analysis and corrective actions:</p>
-              <p style="text-align:center;margin:28px 0">
-                <a href="{form_link}"
-                   style="display:inline-block;padding:12px 20px;border-radius:6px;background:#0078D7;color:#fff;text-decoration:none;font-weight:600">
-                  Open KPI Form
-                </a>
-              </p>
-              <p style="font-size:12px;color:#666;margin-top:24px">
-                This is an automated reminder from the KPI tracking system.
-              </p>
-            </div>
-          </div>
-        </body>
-        </html>
-        """
-        msg.attach(MIMEText(html_content, 'html'))
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    try:
+        with observe_query('start_or_resume_run'), conn.cursor() as cur:
+            cur.execute(INSERT_RUN_SQL, (week,))
+            run_id = cur.fetchone()[0]
+        conn.commit()
+        return run_id, week, 0, False
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        db_pool.putconn(conn)
 
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=10) as server:
-            server.send_message(msg)
+def close_stale_run(run_id):
+    """Bump the KPIs a stale run emailed but never updated, then close it"""
+    pending = get_pending_kpi_updates(run_id)
+    updated = sum(update_kpi_created_at(kpi_id, run_id) for kpi_id in pending)
 
-        print(f"✅ Email sent successfully to {responsible_email} for KPI: {kpi_name} at Plant: {plant_name}")
-        return True
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    try:
+        with observe_query('close_stale_run'), conn.cursor() as cur:
+            cur.execute(CLOSE_STALE_RUN_SQL, (run_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        db_pool.putconn(conn)
+    logger.warning("Closed stale run #%s (%d/%d pending KPI update(s) applied)", run_id, updated, len(pending))
+
+def get_sent_groups(run_id):
+    """Return the set of (responsible_id, plant_id, week) already emailed in a run"""
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    try:
+        with observe_query('get_sent_groups'), conn.cursor() as cur:
+            cur.execute(SENT_GROUPS_SQL, (run_id,))
+            return set(cur.fetchall())
+    finally:
+        db_pool.putconn(conn)
+
+def record_group_sent(run_id, responsible_id, plant_id, week, kpi_ids):
+    """Write a sent-ledger entry and advance the run checkpoint in one transaction"""
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    try:
+        with observe_query('record_group_sent'), conn.cursor() as cur:
+            cur.execute(INSERT_LEDGER_SQL, (run_id, responsible_id, plant_id, week, list(kpi_ids)))
+            cur.execute(ADVANCE_CHECKPOINT_SQL, (cur.rowcount, run_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        db_pool.putconn(conn)
+
+def get_pending_kpi_updates(run_id):
+    """KPI ids emailed in a run whose created_at has not been bumped yet"""
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    try:
+        with observe_query('get_pending_kpi_updates'), conn.cursor() as cur:
+            cur.execute(PENDING_KPI_UPDATES_SQL, (run_id, run_id))
+            return [row[0] for row in cur.fetchall()]
+    finally:
+        db_pool.putconn(conn)
 
+def set_run_phase(run_id, phase, completed=False):
+    """Move a run to the given phase; a completed run is never resumed"""
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    try:
+        with observe_query('set_run_phase'), conn.cursor() as cur:
+            cur.execute(SET_RUN_PHASE_SQL, (phase, completed, completed, run_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        db_pool.putconn(conn)
+
+def record_run_history(params):
+    """Persist one scheduler run (phase timings, counts, send latency percentiles)"""
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    try:
+        with observe_query('record_run_history'), conn.cursor() as cur:
+            cur.execute(INSERT_RUN_HISTORY_SQL, params)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        db_pool.putconn(conn)
+
+def get_run_history(limit=10):
+    """Most recent scheduler runs, newest first"""
+    try:
+        ensure_scheduler_tables()
     except Exception as e:
-        print(f"❌ Failed to send email to {responsible_email}: {str(e)}")
-        traceback.print_exc()
-        return False
+        logger.error("Database error in get_run_history: %s", e)
+        return []
+
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    try:
+        with observe_query('get_run_history'), conn.cursor() as cur:
+            cur.execute(RECENT_RUN_HISTORY_SQL, (limit,))
+            columns = [column[0] for column in cur.description]
+            return [dict(zip(columns, row)) for row in cur.fetchall()]
+    except Exception as e:
+        logger.exception("Database error in get_run_history: %s", e)
+        return []
+    finally:
+        db_pool.putconn(conn)
+
+def _format_ms(value, seconds=True):
+    """Format a latency given in seconds (or milliseconds) for display; None becomes a dash"""
+    if value is None:
+        return '-'
+    return f"{value * 1000 if seconds else value:.0f} ms"
 
 # ========================================
 # SCHEDULER FUNCTIONS
 # ========================================
 
-def get_due_kpis_with_responsibles():
+def get_due_kpis_with_responsibles(primary=False):
     """
     Fetch all KPIs that are due (frequence_de_envoi <= NOW()) 
     along with their assigned responsibles and plants for the current week.
+    primary=True skips the replica: the scheduler must see its own KPI updates,
+    or a lagging replica would make it email the same KPIs again.
     Returns: List of tuples (kpi_id, kpi_name, responsible_id, resp_name, email, week, plant_name, plant_id)
     """
-    conn = db_pool.getconn()
     current_week = get_current_iso_week()
 
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT DISTINCT 
-                    k.kpi_id,
-                    k."KPI_name",
-                    r.responsible_id,
-                    r.name,
-                    r.email,
-                    kv.week,
-                    COALESCE(p.name, 'N/A') as plant_name,
-                    kv.plant_id
-                FROM public."Kpi" k
-                JOIN public.kpi_values kv ON kv.kpi_id = k.kpi_id
-                JOIN public."Responsible" r ON r.responsible_id = kv.responsible_id
-                LEFT JOIN public.plants p ON kv.plant_id = p.plant_id
-                WHERE k.frequence_de_envoi <= NOW()
-                  AND kv.week = %s
-                ORDER BY kv.plant_id, k.kpi_id, r.responsible_id
-                """,
-                (current_week,),
-            )
+    def fetch(cur):
+        cur.execute(DUE_KPIS_SQL, (current_week,))
+        return cur.fetchall()
 
-            results = cur.fetchall()
-            print(f"📊 Found {len(results)} KPI-Responsible-Plant combinations due for week {current_week}")
-            return results
+    try:
+        results = run_read('get_due_kpis_with_responsibles', fetch, primary=primary)
+        logger.info("Found %d KPI-Responsible-Plant combinations due for week %s", len(results), current_week)
+        return results
 
     except Exception as e:
-        print(f"❌ Error fetching due KPIs: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error fetching due KPIs: %s", e)
         return []
-    finally:
-        db_pool.putconn(conn)
 
-def update_kpi_created_at(kpi_id):
+def update_kpi_created_at(kpi_id, run_id=None):
     """
     Update created_at = NOW() to trigger recalculation of frequence_de_envoi
     This will automatically calculate the next send date based on the frequency rule
+    When run_id is given the update is recorded against that run in the same transaction
     """
+    db_pool = get_db_pool()
     conn = db_pool.getconn()
     try:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                UPDATE public."Kpi"
-                SET created_at = NOW()
-                WHERE kpi_id = %s
-                RETURNING kpi_id, "KPI_name", created_at, frequence_de_envoi
-                """,
-                (kpi_id,),
-            )
+        with observe_query('update_kpi_created_at'), conn.cursor() as cur:
+            cur.execute(UPDATE_KPI_CREATED_AT_SQL, (kpi_id,))
 
             result = cur.fetchone()
+            if run_id is not None:
+                cur.execute(RECORD_KPI_UPDATE_SQL, (run_id, kpi_id))
             conn.commit()
 
             if result:
                 kpi_id, kpi_name, new_created, new_freq = result
-                print(f"   ✅ Updated '{kpi_name}' (ID:{kpi_id})")
-                print(f"      New created_at: {new_created}")
-                print(f"      Next send scheduled: {new_freq}")
+                logger.debug("Updated KPI '%s' (ID:%s)", kpi_name, kpi_id,
+                             extra={'created_at': new_created, 'next_send': new_freq})
                 return True
             else:
-                print(f"   ⚠️ KPI {kpi_id} not found for update")
+                logger.warning("KPI %s not found for update", kpi_id)
                 return False
 
     except Exception as e:
-        print(f"   ❌ Error updating KPI {kpi_id}: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error updating KPI %s: %s", kpi_id, e)
         conn.rollback()
         return False
     finally:
         db_pool.putconn(conn)
 
+def schedule_deferred_retry():
+    """Schedule a one-off rerun for when the SMTP circuit allows its next probe"""
+    if not scheduler.running:
+        logger.info("Scheduler not started, deferred sends wait for the next run")
+        return
+    run_date = datetime.now(pytz.timezone('Africa/Tunis')) + timedelta(seconds=smtp_breaker.retry_in() + 1)
+    scheduler.add_job(
+        scheduled_email_task,
+        'date',
+        run_date=run_date,
+        id='kpi_email_retry',
+        name='KPI Email Retry (deferred sends)',
+        replace_existing=True
+    )
+    logger.info("Deferred sends will be retried at %s", run_date)
+
 def scheduled_email_task():
     """
     Main automated scheduler task:
     1. Gets current ISO week
-    2. Finds all KPIs where frequence_de_envoi <= NOW()
-    3. Groups by plant and sends separate email per plant
-    4. Updates created_at to trigger next cycle calculation
+    2. Opens a new run, or resumes the last unfinished one
+    3. Finds all KPIs where frequence_de_envoi <= NOW()
+    4. Groups by plant and sends separate email per plant, skipping groups
+       already recorded in the sent-ledger for this run
+    5. Updates created_at to trigger next cycle calculation
+    Safe to rerun: a restarted or repeated run only does the remaining work.
+    Returns False if skipped because another run holds the scheduler lock.
     """
-    print(f"\n{'='*70}")
-    print(f"⏰ SCHEDULED TASK RUNNING at {datetime.now()}")
-    print(f"{'='*70}")
+    logger.info("Scheduled task running")
 
+    db_pool = get_db_pool()
+    lock_conn = acquire_scheduler_lock(db_pool)
+    if lock_conn is None:
+        logger.warning("Another scheduler run is in progress, skipping")
+        return False
+
+    try:
+        if profiler is not None and profiler.take_scheduler_arm():
+            with profiler.profile(SCHEDULER_TARGET) as profile_name:
+                logger.info("Profiling this run to %s", profile_name)
+                _run_email_task()
+        else:
+            _run_email_task()
+    finally:
+        run_id_var.set(None)
+        release_scheduler_lock(db_pool, lock_conn)
+    return True
+
+def _run_email_task():
+    """Body of scheduled_email_task, executed while holding the scheduler lock"""
+    timer = PhaseTimer()
+    run_started_at = datetime.now(pytz.utc)
     current_week = get_current_iso_week()
-    print(f"📅 Current ISO Week: {current_week}")
+
+    if mail_transport.render_only:
+        # Dry run: nothing is sent, so nothing may be recorded as sent
+        run_id, resumed = None, False
+        logger.info("Render-only mode: writing messages to %s, no ledger or KPI updates", mail_transport)
+    else:
+        ensure_scheduler_tables()
+        run_id, run_week, groups_done, resumed = start_or_resume_run(current_week)
+        run_id_var.set(run_id)
+        if resumed:
+            logger.info("Resuming run #%s (week %s, %d group(s) already sent)", run_id, run_week, groups_done)
+        else:
+            logger.info("Started run #%s for week %s", run_id, current_week)
+
+    timer.lap('setup')
 
     # Get all due KPIs with their responsibles and plants
-    due_records = get_due_kpis_with_responsibles()
+    due_records = get_due_kpis_with_responsibles(primary=True)
+    timer.lap('query')
 
     if not due_records:
-        print("ℹ️  No KPIs are due for sending at this time.")
-        print(f"{'='*70}\n")
-        return
-
-    # Group by (responsible_id, plant_id) to send one email per plant
-    plant_groups = {}
-    for kpi_id, kpi_name, responsible_id, resp_name, email, week, plant_name, plant_id in due_records:
-        key = (responsible_id, plant_id)
-        if key not in plant_groups:
-            plant_groups[key] = {
-                'responsible_id': responsible_id,
-                'resp_name': resp_name,
-                'email': email,
+        logger.info("No KPIs are due for sending at this time")
+
+    # Group by (responsible_id, plant_id) to send one email per plant;
+    # in digest mode all of a responsible's plants are coalesced into one email
+    plant_groups = group_due_records(due_records)
+    batches = batch_plant_groups(plant_groups, EMAIL_DIGEST_MODE)
+
+    # Render stage setup done once per run rather than once per email
+    renderer = EmailRenderer(EMAIL_USER, _base_url())
+    tally = RunTally(plant_groups, get_sent_groups(run_id) if resumed else ())
+    timer.lap('group')
+
+    if plant_groups:
+        mode = "digest email(s)" if EMAIL_DIGEST_MODE else "plant-responsible combination(s)"
+        logger.info("Processing %d %s for %d plant group(s)", len(batches), mode, len(plant_groups))
+
+    # Send one email per plant, or one per responsible in digest mode
+    for groups in batches:
+        pending = tally.pending(groups)
+        if not pending:
+            continue
+
+        # Fail fast while the SMTP circuit is open; the groups are deferred to a later run
+        if not mail_transport.allow():
+            tally.defer(pending)
+            continue
+
+        responsible_id = pending[0]['responsible_id']
+        email = pending[0]['email']
+        week = pending[0]['week']
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Sending KPI reminder", extra={
+                'to': email,
+                'responsible': pending[0]['resp_name'],
                 'week': week,
-                'plant_name': plant_name,
-                'plant_id': plant_id,
-                'kpis': []
-            }
-        plant_groups[key]['kpis'].append({
-            'kpi_id': kpi_id,
-            'kpi_name': kpi_name
-        })
-
-    kpis_processed = set()
-    emails_sent = 0
-    emails_failed = 0
-
-    print(f"\n📧 Processing {len(plant_groups)} plant-responsible combination(s):\n")
-
-    # Send one email per plant
-    for key, group_data in plant_groups.items():
-        responsible_id = group_data['responsible_id']
-        resp_name = group_data['resp_name']
-        email = group_data['email']
-        week = group_data['week']
-        plant_name = group_data['plant_name']
-        plant_id = group_data['plant_id']
-        kpis = group_data['kpis']
-        
-        # Use the first KPI name for the email subject (or you could list all)
-        kpi_name = kpis[0]['kpi_name']
-        if len(kpis) > 1:
-            kpi_name = f"{kpi_name} and {len(kpis)-1} more"
-
-        print(f"📤 Sending KPI reminder:")
-        print(f"   Plant: {plant_name} (ID: {plant_id})")
-        print(f"   KPIs: {', '.join([k['kpi_name'] for k in kpis])}")
-        print(f"   To: {resp_name} ({email})")
-        print(f"   Week: {week}")
+                'plants': [(group_data['plant_id'], group_data['plant_name']) for group_data in pending],
+                'kpis': len(batch_kpi_ids(pending)),
+            })
 
+        send_started = time.perf_counter()
         try:
-            success = send_kpi_email(responsible_id, resp_name, email, kpi_name, week, plant_name, plant_id)
-
-            if success:
-                emails_sent += 1
-                # Mark all KPIs in this email as processed
-                for kpi in kpis:
-                    kpis_processed.add(kpi['kpi_id'])
-                print(f"   ✅ Email sent successfully\n")
-            else:
-                emails_failed += 1
-                print(f"   ❌ Email failed to send\n")
-
+            success = mail_transport.send(render_batch(renderer, pending))
         except Exception as e:
-            emails_failed += 1
-            print(f"   ❌ Exception: {str(e)}\n")
-            traceback.print_exc()
+            logger.exception("Exception while sending to %s: %s", email, e)
+            success = False
+        tally.record_send(pending, success, time.perf_counter() - send_started)
+
+        if not success:
+            logger.warning("Email to %s failed to send", email)
+        elif run_id is not None:
+            try:
+                for group_data in pending:
+                    record_group_sent(run_id, responsible_id, group_data['plant_id'], week,
+                                      [k['kpi_id'] for k in group_data['kpis']])
+            except Exception as e:
+                logger.warning("Email to %s sent but not recorded in ledger: %s", email, e)
+
+    if tally.skipped:
+        logger.info("Skipped %d group(s) already emailed in run #%s", tally.skipped, run_id)
+    if tally.deferred:
+        logger.warning("SMTP circuit open: deferred %d plant group(s) to a later run", tally.deferred)
+        schedule_deferred_retry()
+
+    mail_transport.flush()
+    timer.lap('send')
+
+    if run_id is None:
+        timer.finish()
+        logger.info("Render-only task completed (%s)", mail_transport, extra={
+            'emails_rendered': tally.sent,
+            'emails_failed': tally.failed,
+            'kpis_covered': len(tally.kpis_processed),
+        })
+        return
 
     # Update KPIs to schedule next send
-    if kpis_processed:
-        print(f"\n🔄 Updating {len(kpis_processed)} KPI(s) for next cycle:\n")
+    set_run_phase(run_id, 'update')
+    pending_updates = tally.kpis_to_update(get_pending_kpi_updates(run_id))
+    kpis_updated = 0
+    if pending_updates:
+        logger.info("Updating %d KPI(s) for next cycle", len(pending_updates))
+
+        for kpi_id in pending_updates:
+            if update_kpi_created_at(kpi_id, run_id):
+                kpis_updated += 1
+
+    run_completed = tally.completed(kpis_updated, pending_updates)
+    set_run_phase(run_id, 'done' if run_completed else 'update', completed=run_completed)
+    timer.lap('update')
+    run_seconds = timer.finish()
 
-        for kpi_id in kpis_processed:
-            update_kpi_created_at(kpi_id)
+    try:
+        record_run_history(tally.history_params(
+            run_id, 'digest' if EMAIL_DIGEST_MODE else 'per-plant', run_started_at, run_seconds, timer.phases,
+            kpis_updated, run_completed,
+        ))
+    except Exception as e:
+        logger.warning("Failed to record run history: %s", e)
 
-    print(f"\n{'='*70}")
-    print(f"✅ TASK COMPLETED:")
-    print(f"   📧 Emails sent: {emails_sent}")
-    print(f"   ❌ Emails failed: {emails_failed}")
-    print(f"   🔄 KPIs updated: {len(kpis_processed)}")
-    print(f"{'='*70}\n")
+    logger.info("Task completed (run #%s)" if run_completed else "Task incomplete (run #%s will resume)", run_id, extra={
+        **tally.summary(),
+        'kpis_updated': kpis_updated,
+        'send_p50': _format_ms(percentile(tally.send_latencies, 50)),
+        'send_p95': _format_ms(percentile(tally.send_latencies, 95)),
+        'duration_seconds': round(run_seconds, 3),
+        'phases': {name: round(seconds, 3) for name, seconds in timer.phases.items()},
+    })
 
 # ========================================
 # FLASK ROUTES
 # ========================================
 
-@app.route('/')
+@bp.before_app_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+    g.request_id_token = request_id_var.set(request.headers.get('X-Request-ID') or new_request_id())
+
+@bp.after_app_request
+def _observe_request_latency(response):
+    global _cold_start_pending
+    started = g.pop('request_started', None)
+    if started is not None:
+        # Route template, not the raw path, so query strings and ids don't explode cardinality
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_REQUEST_SECONDS.labels(route, request.method, response.status_code).observe(time.perf_counter() - started)
+    if _cold_start_pending:
+        _cold_start_pending = False
+        cold_start = time.perf_counter() - APP_IMPORT_STARTED
+        APP_COLD_START_SECONDS.set(cold_start)
+        logger.info("First request served %.0f ms after import", cold_start * 1000, extra={'route': request.path})
+    response.headers['X-Request-ID'] = request_id_var.get() or ''
+    if DB_READ_HOST and g.get('wrote_primary'):
+        response.set_cookie(READ_YOUR_WRITES_COOKIE, str(time.time()), max_age=READ_YOUR_WRITES_SECONDS,
+                            httponly=True, samesite='Lax')
+    return response
+
+@bp.teardown_app_request
+def _reset_request_id(exc):
+    token = g.pop('request_id_token', None)
+    if token is not None:
+        request_id_var.reset(token)
+
+# Registered by create_app() only when profiling is enabled
+profiling_bp = Blueprint('profiling', __name__)
+
+PROFILES_ADMIN_PATH = '/admin/profiles'
+PROFILES_ADMIN_COOKIE = 'kpi_profiles_admin'
+
+def _require_admin_token():
+    """
+    Let the caller through with a session cookie, or a single-use token signed
+    for /admin/profiles (header, or ?token= from a browser) that starts one.
+    Returns a redirect dropping ?token= from the URL, so it stays out of access
+    logs and Referer headers, or None to serve the page.
+    """
+    if profiler.verify(request.cookies.get(PROFILES_ADMIN_COOKIE), ADMIN_SESSION_TARGET):
+        return None
+    token = request.headers.get(TOKEN_HEADER) or request.args.get('token')
+    if not profiler.consume(token, PROFILES_ADMIN_PATH):
+        abort(404)
+    g.profiles_admin_login = True
+    if request.method == 'GET' and 'token' in request.args:
+        return redirect(request.path)
+    return None
+
+@profiling_bp.after_request
+def _set_admin_cookie(response):
+    if g.pop('profiles_admin_login', False):
+        response.set_cookie(PROFILES_ADMIN_COOKIE, profiler.session_token(), max_age=profiler.max_age,
+                            path=PROFILES_ADMIN_PATH, secure=request.is_secure, httponly=True, samesite='Strict')
+    return response
+
+@profiling_bp.before_app_request
+def _start_request_profile():
+    token = request.headers.get(TOKEN_HEADER)
+    # Admin tokens are single-use too; leave them to _require_admin_token
+    if request.path.startswith(PROFILES_ADMIN_PATH):
+        return
+    if token and profiler.consume(token, request.path):
+        g.profile_name = profiler.new_profile_name(request.path)
+        g.profile = profiler.start()
+
+@profiling_bp.after_app_request
+def _add_profile_header(response):
+    if 'profile_name' in g:
+        response.headers['X-Profile-Id'] = g.profile_name
+    return response
+
+@profiling_bp.teardown_app_request
+def _stop_request_profile(exc):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profiler.stop(profile, g.pop('profile_name'))
+
+@profiling_bp.route(PROFILES_ADMIN_PATH)
+def list_profiles():
+    """Recent profile dumps; needs a token signed for /admin/profiles"""
+    login_redirect = _require_admin_token()
+    if login_redirect is not None:
+        return login_redirect
+    rows = ""
+    for item in profiler.list_profiles():
+        rows += f"""
+            <tr>
+                <td><a href="{PROFILES_ADMIN_PATH}/{item['name']}">{item['name']}</a></td>
+                <td>{item['modified'].strftime('%Y-%m-%d %H:%M:%S')}</td>
+                <td>{item['size'] / 1024:.1f} KB</td>
+            </tr>
+        """
+    if not rows:
+        rows = '<tr><td colspan="3" style="color: #666;">No profiles recorded yet.</td></tr>'
+
+    return f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <meta charset="utf-8">
+        <title>Profiles</title>
+        <style>
+            body {{ font-family: 'Segoe UI', sans-serif; background: #f4f6f9; padding: 40px; }}
+            .container {{ max-width: 1000px; margin: 0 auto; background: #fff; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
+            h1 {{ color: #0078D7; }}
+            .info {{ background: #e7f3ff; padding: 15px; border-radius: 5px; margin: 15px 0; border-left: 4px solid #0078D7; }}
+            .label {{ font-weight: 600; color: #333; }}
+            code {{ background: #f4f4f4; padding: 2px 6px; border-radius: 4px; }}
+            table {{ width: 100%; border-collapse: collapse; font-size: 13px; }}
+            th, td {{ padding: 8px; border-bottom: 1px solid #eee; text-align: left; }}
+            th {{ background: #f8f9fa; color: #333; }}
+            .button {{ display: inline-block; margin: 10px 5px 0 0; padding: 10px 20px; background: #0078D7; color: white; border: none; border-radius: 6px; font-weight: 600; cursor: pointer; }}
+        </style>
+    </head>
+    <body>
+        <div class="container">
+            <h1>🔬 Profiles</h1>
+            <div class="info">
+                <div><span class="label">Directory:</span> {profiler.directory} (newest {profiler.keep} kept)</div>
+                <div><span class="label">Next scheduler run profiled:</span> {profiler.scheduler_armed}</div>
+                <div>Profile one request by sending <code>{TOKEN_HEADER}</code> signed for its path
+                     (<code>python profiling.py sign /form</code>). Open dumps with <code>python -m pstats</code> or snakeviz.</div>
+            </div>
+            <form method="post" action="{PROFILES_ADMIN_PATH}/arm-scheduler">
+                <button class="button" type="submit">⏰ Profile Next Scheduler Run</button>
+            </form>
+            <h2>Recent Profiles</h2>
+            <table>
+                <tr><th>File</th><th>Written</th><th>Size</th></tr>
+                {rows}
+            </table>
+        </div>
+    </body>
+    </html>
+    """
+
+@profiling_bp.route(f'{PROFILES_ADMIN_PATH}/arm-scheduler', methods=['POST'])
+def arm_scheduler_profile():
+    """Profile the next scheduled_email_task run"""
+    _require_admin_token()
+    profiler.arm_scheduler()
+    logger.info("Next scheduler run will be profiled")
+    return redirect(PROFILES_ADMIN_PATH)
+
+@profiling_bp.route(f'{PROFILES_ADMIN_PATH}/<name>')
+def download_profile(name):
+    """Download one .pstats dump"""
+    login_redirect = _require_admin_token()
+    if login_redirect is not None:
+        return login_redirect
+    if not name.endswith('.pstats'):
+        abort(404)
+    return send_from_directory(os.path.abspath(profiler.directory), name, as_attachment=True)
+
+@bp.route('/metrics')
+def metrics():
+    """Prometheus metrics in text exposition format"""
+    return generate_latest(REGISTRY), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
+@bp.route('/')
 def home():
     """Home page with system status"""
     next_run = scheduler.get_jobs()[0].next_run_time if scheduler.get_jobs() else "Not scheduled"
@@ -461,12 +1036,12 @@ def home():
     </html>
     '''
 
-@app.route('/dashboard')
+@bp.route('/dashboard')
 def dashboard():
     """Redirect to Power BI dashboard"""
     return redirect(POWER_BI_URL)
 
-@app.route('/scheduler-status')
+@bp.route('/scheduler-status')
 def scheduler_status():
     """Check scheduler status and jobs"""
     jobs = scheduler.get_jobs()
@@ -481,6 +1056,38 @@ def scheduler_status():
         })
     
     current_time = datetime.now(pytz.timezone('Africa/Tunis'))
+    breaker = smtp_breaker.snapshot()
+    breaker_color = {'closed': '#28a745', 'half_open': '#e67e22', 'open': '#dc3545'}[breaker['state']]
+    breaker_opened_at = datetime.fromtimestamp(breaker['opened_at']) if breaker['opened_at'] else '-'
+
+    # Last N scheduler runs from the run-history table
+    runs_limit = min(max(request.args.get('runs', 10, type=int), 1), 100)
+    runs = get_run_history(runs_limit)
+
+    def _seconds(value):
+        return f"{value:.1f}s" if value is not None else '-'
+
+    runs_html = ""
+    for run in runs:
+        status_color = '#28a745' if run['completed'] else '#e67e22'
+        runs_html += f"""
+            <tr>
+                <td>{run['started_at'].astimezone(pytz.timezone('Africa/Tunis')).strftime('%Y-%m-%d %H:%M:%S')}</td>
+                <td>#{run['run_id']}</td>
+                <td>{run['mode']}</td>
+                <td><strong>{_seconds(run['duration_seconds'])}</strong></td>
+                <td>{_seconds(run['query_seconds'])} / {_seconds(run['group_seconds'])} / {_seconds(run['send_seconds'])} / {_seconds(run['update_seconds'])}</td>
+                <td>{run['groups_processed']}</td>
+                <td>{run['emails_sent']}</td>
+                <td>{run['emails_failed']}</td>
+                <td>{run['groups_deferred']}</td>
+                <td>{run['kpis_updated']}</td>
+                <td>{_format_ms(run['send_p50_ms'], seconds=False)} / {_format_ms(run['send_p95_ms'], seconds=False)}</td>
+                <td style="color: {status_color}; font-weight: 600;">{'completed' if run['completed'] else 'incomplete'}</td>
+            </tr>
+        """
+    if not runs:
+        runs_html = '<tr><td colspan="12" style="color: #666;">No runs recorded yet.</td></tr>'
     
     # Build jobs HTML separately to avoid f-string nesting issues
     jobs_html = ""
@@ -502,7 +1109,7 @@ def scheduler_status():
         <title>Scheduler Status</title>
         <style>
             body {{ font-family: 'Segoe UI', sans-serif; background: #f4f6f9; padding: 40px; }}
-            .container {{ max-width: 900px; margin: 0 auto; background: #fff; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
+            .container {{ max-width: 1200px; margin: 0 auto; background: #fff; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
             h1 {{ color: #0078D7; }}
             .info {{ background: #e7f3ff; padding: 15px; border-radius: 5px; margin: 15px 0; border-left: 4px solid #0078D7; }}
             .job {{ background: #f8f9fa; padding: 15px; margin: 10px 0; border-radius: 5px; border-left: 4px solid #28a745; }}
@@ -512,6 +1119,9 @@ def scheduler_status():
             .button:hover {{ background: #005ea6; }}
             .test-btn {{ background: #28a745; }}
             .test-btn:hover {{ background: #218838; }}
+            table {{ width: 100%; border-collapse: collapse; font-size: 13px; }}
+            th, td {{ padding: 8px; border-bottom: 1px solid #eee; text-align: left; white-space: nowrap; }}
+            th {{ background: #f8f9fa; color: #333; }}
         </style>
     </head>
     <body>
@@ -525,8 +1135,30 @@ def scheduler_status():
                 <div><span class="label">Total Jobs:</span> {len(jobs)}</div>
             </div>
             
+            <h2>📮 SMTP Circuit Breaker</h2>
+            <div class="info" style="border-left-color: {breaker_color};">
+                <div><span class="label">State:</span> {breaker['state']}</div>
+                <div><span class="label">Consecutive Failures:</span> {breaker['consecutive_failures']} / {breaker['failure_threshold']}</div>
+                <div><span class="label">Opened At:</span> {breaker_opened_at}</div>
+                <div><span class="label">Next Probe In:</span> {breaker['retry_in']:.0f}s (every {breaker['reset_timeout']}s while open)</div>
+                <div><span class="label">Sends Rejected Fast:</span> {breaker['rejected']}</div>
+                <div><span class="label">Last Error:</span> {breaker['last_error'] or '-'}</div>
+            </div>
+
             <h2>📋 Scheduled Jobs</h2>
             {jobs_html}
+
+            <h2>📈 Recent Runs (last {runs_limit})</h2>
+            <div style="overflow-x: auto;">
+                <table>
+                    <tr>
+                        <th>Started (Africa/Tunis)</th><th>Run</th><th>Mode</th><th>Duration</th>
+                        <th>Query / Group / Send / Update</th><th>Groups</th><th>Sent</th><th>Failed</th>
+                        <th>Deferred</th><th>KPIs Updated</th><th>Send p50 / p95</th><th>Status</th>
+                    </tr>
+                    {runs_html}
+                </table>
+            </div>
             
             <h2>🧪 Test Functions</h2>
             <a href="/test-email-task" class="button test-btn">🧪 Run Email Task Manually</a>
@@ -537,14 +1169,19 @@ def scheduler_status():
     </html>
     """
 
-@app.route('/test-email-task')
+@bp.route('/test-email-task')
 def test_email_task():
     """Manually trigger the email task for testing"""
     try:
-        print("\n" + "="*70)
-        print("🧪 MANUAL TEST TRIGGERED from /test-email-task")
-        print("="*70)
-        scheduled_email_task()
+        logger.info("Manual test triggered from /test-email-task")
+        if not scheduled_email_task():
+            return '''
+        <div style="font-family: Arial; padding: 40px; text-align: center;">
+            <h2 style="color: #e67e22;">⏳ Email Task Skipped</h2>
+            <p>Another scheduler run is in progress. Try again once it has finished.</p>
+            <a href="/scheduler-status" style="display: inline-block; margin-top: 20px; padding: 12px 24px; background: #0078D7; color: white; text-decoration: none; border-radius: 6px;">Back to Scheduler Status</a>
+        </div>
+        '''
         return '''
         <div style="font-family: Arial; padding: 40px; text-align: center;">
             <h2 style="color: #28a745;">✅ Email Task Executed</h2>
@@ -562,7 +1199,7 @@ def test_email_task():
         </div>
         '''
 
-@app.route('/test-due-kpis')
+@bp.route('/test-due-kpis')
 def test_due_kpis():
     """Check which KPIs are currently due"""
     try:
@@ -625,7 +1262,7 @@ def test_due_kpis():
         </div>
         """
 
-@app.route('/form')
+@bp.route('/form')
 def form_page():
     """Display KPI form filtered by plant_id if provided"""
     try:
@@ -633,7 +1270,7 @@ def form_page():
         week = request.args.get('week', get_current_iso_week())
         plant_id = request.args.get('plant_id')  # NEW: Get plant_id from URL
 
-        print(f"📋 Form accessed - Responsible: {responsible_id}, Week: {week}, Plant: {plant_id}")
+        logger.debug("Form accessed", extra={'responsible_id': responsible_id, 'week': week, 'plant_id': plant_id})
 
         # Pass plant_id to filter KPIs
         data = get_responsible_with_kpis(responsible_id, week, plant_id)
@@ -643,17 +1280,15 @@ def form_page():
         # Get actual plant name from URL parameter if filtering
         actual_plant_name = responsible['plant_name']
         if plant_id:
-            conn = db_pool.getconn()
-            try:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT name FROM public.plants WHERE plant_id = %s", (plant_id,))
-                    result = cur.fetchone()
-                    if result:
-                        actual_plant_name = result[0]
-            finally:
-                db_pool.putconn(conn)
+            def fetch_plant_name(cur):
+                cur.execute("SELECT name FROM public.plants WHERE plant_id = %s", (plant_id,))
+                return cur.fetchone()
 
-        print(f"📋 Data loaded - Responsible: {responsible['name']}, Plant: {actual_plant_name}, KPIs: {len(kpis)}")
+            result = run_read('get_plant_name', fetch_plant_name)
+            if result:
+                actual_plant_name = result[0]
+
+        logger.debug("Form data loaded", extra={'responsible': responsible['name'], 'plant': actual_plant_name, 'kpis': len(kpis)})
 
         if not kpis:
             return '''
@@ -782,11 +1417,10 @@ def form_page():
         </html>
         """
     except Exception as e:
-        print(f"❌ Error in form_page: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error in form_page: %s", e)
         return f'<p style="color:red; padding: 20px;">Error loading form: {str(e)}</p>'
 
-@app.route('/submit', methods=['POST'])
+@bp.route('/submit', methods=['POST'])
 def submit_form():
     """Handle form submission"""
     try:
@@ -794,7 +1428,7 @@ def submit_form():
         week = request.form.get('week')
         plant_id = request.form.get('plant_id')  # NEW: Get plant_id from form
 
-        print(f"📝 Form submission - Responsible: {responsible_id}, Week: {week}, Plant: {plant_id}")
+        logger.debug("Form submission", extra={'responsible_id': responsible_id, 'week': week, 'plant_id': plant_id})
 
         # Collect analyse_* and actions_* fields
         kpi_data = {}
@@ -814,15 +1448,17 @@ def submit_form():
             </div>
             ''', 200
 
+        db_pool = get_db_pool()
         conn = db_pool.getconn()
         try:
             with conn.cursor() as cur:
                 for kpi_values_id, data in kpi_data.items():
-                    cur.execute(
-                        'SELECT "analyse", actions_correctives FROM public.kpi_values WHERE kpi_values_id = %s',
-                        (kpi_values_id,),
-                    )
-                    old = cur.fetchone()
+                    with observe_query('submit_select_kpi_value'):
+                        cur.execute(
+                            'SELECT "analyse", actions_correctives FROM public.kpi_values WHERE kpi_values_id = %s',
+                            (kpi_values_id,),
+                        )
+                        old = cur.fetchone()
                     if not old:
                         continue
 
@@ -830,17 +1466,20 @@ def submit_form():
                     new_analyse = data.get('analyse', old_analyse)
                     new_actions = data.get('actions_correctives', old_actions)
 
-                    cur.execute(
-                        """
-                        UPDATE public.kpi_values
-                        SET "analyse" = %s, actions_correctives = %s
-                        WHERE kpi_values_id = %s
-                        """,
-                        (new_analyse, new_actions, kpi_values_id),
-                    )
-
-            conn.commit()
-            print(f"✅ Successfully updated {len(kpi_data)} KPI value(s)")
+                    with observe_query('submit_update_kpi_value'):
+                        cur.execute(
+                            """
+                            UPDATE public.kpi_values
+                            SET "analyse" = %s, actions_correctives = %s
+                            WHERE kpi_values_id = %s
+                            """,
+                            (new_analyse, new_actions, kpi_values_id),
+                        )
+
+            with observe_query('submit_commit'):
+                conn.commit()
+            mark_primary_write()
+            logger.info("Updated %d KPI value(s)", len(kpi_data), extra={'responsible_id': responsible_id, 'week': week})
 
             # Build redirect URL with plant_id if provided
             form_url = f"/form?responsible_id={responsible_id}&week={week}"
@@ -894,52 +1533,92 @@ def submit_form():
             db_pool.putconn(conn)
 
     except Exception as e:
-        print(f"❌ Error in submit_form: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error in submit_form: %s", e)
         return f'<h2 style="color:red; padding: 20px;">❌ Failed to submit KPI values</h2><p>{str(e)}</p>', 500
 
 # ========================================
-# INITIALIZE SCHEDULER
+# APP FACTORY & SCHEDULER
 # ========================================
 
-scheduler = BackgroundScheduler(timezone=pytz.timezone('Africa/Tunis'))
-scheduler.add_job(
-    scheduled_email_task,
-    'cron',
-    hour=9,
-    minute=53,
-    timezone=pytz.timezone('Africa/Tunis'),
-    id='kpi_email_scheduler',
-    name='KPI Automated Email Scheduler (Plant-based)'
-)
-scheduler.start()
-
-print("\n" + "="*70)
-print("✅ KPI AUTOMATION SYSTEM INITIALIZED (PLANT-BASED EMAILS)")
-print("="*70)
-print(f"📅 Scheduler: Active")
-print(f"⏰ Schedule: Daily at 08:00 AM (Africa/Tunis)")
-print(f"📧 Next run: {scheduler.get_jobs()[0].next_run_time}")
-print(f"🌐 Server: Running on port {PORT}")
-print(f"🏭 Mode: One email per plant (grouped KPIs)")
-print("="*70 + "\n")
+def start_scheduler():
+    """Add the daily email job and start the background scheduler; no-op if already running"""
+    with _scheduler_lock:
+        if scheduler.running:
+            return scheduler
+        scheduler.add_job(
+            scheduled_email_task,
+            'cron',
+            hour=9,
+            minute=53,
+            timezone=pytz.timezone('Africa/Tunis'),
+            id='kpi_email_scheduler',
+            name='KPI Automated Email Scheduler (Plant-based)',
+            replace_existing=True
+        )
+        scheduler.start()
+
+    logger.info("Scheduler started", extra={
+        'next_run': scheduler.get_job('kpi_email_scheduler').next_run_time,
+        'mode': 'digest' if EMAIL_DIGEST_MODE else 'per-plant',
+    })
+    return scheduler
+
+def create_app(start_background_scheduler=None):
+    """
+    Build the Flask app. Nothing connects at build time: the database pool
+    opens on the first query, and the scheduler starts only when
+    start_background_scheduler (default: SCHEDULER_ENABLED) is true.
+    """
+    global profiler
+    started = time.perf_counter()
+    setup_logging()
+
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+
+    profiler = profiler_from_env()
+    if profiler is not None:
+        app.register_blueprint(profiling_bp)
+
+    if start_background_scheduler is None:
+        start_background_scheduler = SCHEDULER_ENABLED
+    if start_background_scheduler:
+        start_scheduler()
+
+    logger.info("KPI automation system initialized in %.0f ms", (time.perf_counter() - started) * 1000, extra={
+        'scheduler': 'active' if scheduler.running else 'disabled',
+        'profiling': profiler is not None,
+        'port': PORT,
+    })
+    return app
+
+_app = None
+_app_lock = threading.Lock()
+
+def __getattr__(name):
+    # App Service runs `gunicorn app:app`; build that app on first access
+    # instead of at import so `import app` stays free of side effects
+    global _app
+    if name == 'app':
+        with _app_lock:
+            if _app is None:
+                _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # ========================================
 # START SERVER
 # ========================================
 
 if __name__ == '__main__':
+    server = create_app()
     try:
-        print(f"🔗 Access points:")
-        print(f"   - Home: http://localhost:{PORT}/")
-        print(f"   - Dashboard: http://localhost:{PORT}/dashboard (redirects to Power BI)")
-        print(f"   - Form: http://localhost:{PORT}/form?responsible_id=1&week=2025-W45&plant_id=1")
-        print(f"   - Scheduler Status: http://localhost:{PORT}/scheduler-status")
-        print("\n" + "="*70 + "\n")
-        app.run(host='0.0.0.0', port=PORT, debug=False)
+        logger.info("Serving on http://localhost:%s/ (status: /scheduler-status, metrics: /metrics)", PORT)
+        server.run(host='0.0.0.0', port=PORT, debug=False)
     except KeyboardInterrupt:
-        print("\n🛑 Server stopped by user")
+        logger.info("Server stopped by user")
     finally:
-        db_pool.closeall()
-        scheduler.shutdown()
-        print("✅ Cleanup complete")
+        close_db_pool()
+        if scheduler.running:
+            scheduler.shutdown()
+        logger.info("Cleanup complete")
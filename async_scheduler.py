@@ -0,0 +1,328 @@
+"""
+Asyncio run mode for the KPI email scheduler.
+
+Same behaviour as scheduled_email_task in app.py (advisory lock, resumable run
+checkpoint, sent-ledger, SMTP circuit breaker, digest and render-only modes),
+but all I/O is non-blocking: Postgres through psycopg 3's async pool and mail
+through aiosmtplib, with sends fanned out under a semaphore-bounded limit.
+Which groups to send, defer or skip and when a run is complete are decided by
+scheduling.RunTally, shared with app.py; this module only does the I/O.
+
+    python async_scheduler.py --concurrency 200
+    python async_scheduler.py --digest --render-only mbox:/tmp/kpi.mbox
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timezone
+
+import aiosmtplib
+from dotenv import load_dotenv
+from psycopg_pool import AsyncConnectionPool
+
+from mailer import CircuitBreaker, EmailRenderer, SmtpTransport, mailbox_transport_from_spec
+from metrics import PhaseTimer
+from scheduling import (
+    SCHEDULER_LOCK_KEY, SCHEDULER_TABLES_DDL, TRY_LOCK_SQL, UNLOCK_SQL, UNFINISHED_RUNS_SQL,
+    INSERT_RUN_SQL, SENT_GROUPS_SQL, INSERT_LEDGER_SQL, ADVANCE_CHECKPOINT_SQL, PENDING_KPI_UPDATES_SQL,
+    SET_RUN_PHASE_SQL, DUE_KPIS_SQL, UPDATE_KPI_CREATED_AT_SQL, RECORD_KPI_UPDATE_SQL,
+    INSERT_RUN_HISTORY_SQL, CLOSE_STALE_RUN_SQL,
+    get_current_iso_week, group_due_records, batch_plant_groups, render_batch,
+    percentile, resumable_run, RunTally,
+)
+from structured_logging import setup_logging, run_id_var
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# ---------- Configuration ----------
+DB_CONNINFO = (
+    f"host={os.getenv('DB_HOST')} port={os.getenv('DB_PORT', 5432)} dbname={os.getenv('DB_NAME')} "
+    f"user={os.getenv('DB_USER')} sslmode={os.getenv('DB_SSLMODE', 'require')}"
+)
+DB_PASSWORD = os.getenv('DB_PASSWORD')
+
+SMTP_SERVER = os.getenv('EMAIL_HOST', 'avocarbon-com.mail.protection.outlook.com')
+SMTP_PORT = int(os.getenv('EMAIL_PORT', 25))
+EMAIL_USER = os.getenv('EMAIL_USER', 'administration.STS@avocarbon.com')
+APP_BASE_URL = os.getenv('APP_BASE_URL', 'https://kpi-subsidy.azurewebsites.net')
+
+SMTP_BREAKER_THRESHOLD = int(os.getenv('SMTP_BREAKER_THRESHOLD', 3))
+SMTP_BREAKER_RESET_SECONDS = int(os.getenv('SMTP_BREAKER_RESET_SECONDS', 300))
+
+SCHEDULER_RESUME_HOURS = int(os.getenv('SCHEDULER_RESUME_HOURS', 6))
+
+# ========================================
+# TRANSPORTS
+# ========================================
+
+class AsyncSmtpTransport(SmtpTransport):
+    """SmtpTransport over aiosmtplib: same breaker, outcome mapping and metrics, non-blocking send"""
+
+    UNREACHABLE_ERRORS = (aiosmtplib.SMTPConnectError, aiosmtplib.SMTPTimeoutError, aiosmtplib.SMTPServerDisconnected)
+    REFUSED_ERRORS = (aiosmtplib.SMTPException,)
+
+    async def send(self, msg):
+        started = time.perf_counter()
+        try:
+            await aiosmtplib.send(msg, hostname=self.host, port=self.port, timeout=self.timeout, start_tls=False)
+        except (aiosmtplib.SMTPException, OSError) as e:
+            return self.record_outcome(self.classify(e), msg['To'], started, e)
+        return self.record_outcome('sent', msg['To'], started)
+
+
+class AsyncMailboxTransport:
+    """Render-only transport for the asyncio run; local mailbox writes are cheap enough to do inline"""
+
+    render_only = True
+
+    def __init__(self, spec):
+        self._mailbox = mailbox_transport_from_spec(spec)
+
+    def allow(self):
+        return True
+
+    async def send(self, msg):
+        return self._mailbox.send(msg)
+
+    def flush(self):
+        self._mailbox.flush()
+
+    def __str__(self):
+        return str(self._mailbox)
+
+# ========================================
+# DATABASE
+# ========================================
+
+async def fetch_all(pool, sql, params=None):
+    async with pool.connection() as conn:
+        cur = await conn.execute(sql, params)
+        return await cur.fetchall()
+
+async def execute(pool, sql, params=None):
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            await conn.execute(sql, params)
+
+async def start_or_resume_run(pool, week):
+    """
+    Resume the newest unfinished run if it is recent and for this week (see
+    app.start_or_resume_run), otherwise close stale runs and open a new one.
+    Returns (run_id, run_week, groups_done, resumed)
+    """
+    run, stale_runs = resumable_run(await fetch_all(pool, UNFINISHED_RUNS_SQL, (SCHEDULER_RESUME_HOURS,)), week)
+    for stale in stale_runs:
+        await close_stale_run(pool, stale[0])
+    if run:
+        return run[0], run[1], run[2], True
+
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            cur = await conn.execute(INSERT_RUN_SQL, (week,))
+            run_id = (await cur.fetchone())[0]
+            return run_id, week, 0, False
+
+async def close_stale_run(pool, run_id):
+    """Bump the KPIs a stale run emailed but never updated, then close it"""
+    pending = [row[0] for row in await fetch_all(pool, PENDING_KPI_UPDATES_SQL, (run_id, run_id))]
+    updated = sum([await update_kpi_created_at(pool, kpi_id, run_id) for kpi_id in pending])
+    await execute(pool, CLOSE_STALE_RUN_SQL, (run_id,))
+    logger.warning("Closed stale run #%s (%d/%d pending KPI update(s) applied)", run_id, updated, len(pending))
+
+async def record_group_sent(pool, run_id, responsible_id, plant_id, week, kpi_ids):
+    """Write a sent-ledger entry and advance the run checkpoint in one transaction"""
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            cur = await conn.execute(INSERT_LEDGER_SQL, (run_id, responsible_id, plant_id, week, list(kpi_ids)))
+            await conn.execute(ADVANCE_CHECKPOINT_SQL, (cur.rowcount, run_id))
+
+async def update_kpi_created_at(pool, kpi_id, run_id):
+    """Bump created_at for a KPI and record it against the run in the same transaction"""
+    try:
+        async with pool.connection() as conn:
+            async with conn.transaction():
+                cur = await conn.execute(UPDATE_KPI_CREATED_AT_SQL, (kpi_id,))
+                result = await cur.fetchone()
+                await conn.execute(RECORD_KPI_UPDATE_SQL, (run_id, kpi_id))
+
+        if result:
+            logger.debug("Updated KPI '%s' (ID:%s)", result[1], result[0], extra={'next_send': result[3]})
+            return True
+        logger.warning("KPI %s not found for update", kpi_id)
+        return False
+
+    except Exception as e:
+        logger.error("Error updating KPI %s: %s", kpi_id, e)
+        return False
+
+# ========================================
+# SCHEDULER TASK
+# ========================================
+
+async def scheduled_email_task_async(pool, transport, concurrency=100, digest=False):
+    """
+    Asyncio equivalent of app.scheduled_email_task.
+    Returns a summary dict of the run.
+    """
+    logger.info("Async scheduled task running (concurrency %d)", concurrency)
+
+    async with pool.connection() as lock_conn:
+        cur = await lock_conn.execute(TRY_LOCK_SQL, (SCHEDULER_LOCK_KEY,))
+        locked = (await cur.fetchone())[0]
+        await lock_conn.commit()
+        if not locked:
+            logger.warning("Another scheduler run is in progress, skipping")
+            return None
+
+        try:
+            return await _run_email_task(pool, transport, concurrency, digest)
+        finally:
+            run_id_var.set(None)
+            await lock_conn.execute(UNLOCK_SQL, (SCHEDULER_LOCK_KEY,))
+            await lock_conn.commit()
+
+async def _run_email_task(pool, transport, concurrency, digest):
+    timer = PhaseTimer()
+    run_started_at = datetime.now(timezone.utc)
+    current_week = get_current_iso_week()
+
+    if transport.render_only:
+        run_id, resumed = None, False
+        logger.info("Render-only mode: writing messages to %s, no ledger or KPI updates", transport)
+    else:
+        await execute(pool, SCHEDULER_TABLES_DDL)
+        run_id, run_week, groups_done, resumed = await start_or_resume_run(pool, current_week)
+        run_id_var.set(run_id)
+        if resumed:
+            logger.info("Resuming run #%s (week %s, %d group(s) already sent)", run_id, run_week, groups_done)
+        else:
+            logger.info("Started run #%s for week %s", run_id, current_week)
+    timer.lap('setup')
+
+    due_records = await fetch_all(pool, DUE_KPIS_SQL, (current_week,))
+    logger.info("Found %d KPI-Responsible-Plant combinations due for week %s", len(due_records), current_week)
+    timer.lap('query')
+
+    plant_groups = group_due_records(due_records)
+    batches = batch_plant_groups(plant_groups, digest)
+    renderer = EmailRenderer(EMAIL_USER, APP_BASE_URL)
+    tally = RunTally(plant_groups, await fetch_all(pool, SENT_GROUPS_SQL, (run_id,)) if resumed else ())
+    semaphore = asyncio.Semaphore(concurrency)
+    timer.lap('group')
+
+    async def send_batch(groups):
+        pending = tally.pending(groups)
+        if not pending:
+            return
+        first = pending[0]
+
+        async with semaphore:
+            if not transport.allow():
+                tally.defer(pending)
+                return
+
+            send_started = time.perf_counter()
+            try:
+                success = await transport.send(render_batch(renderer, pending))
+            except Exception as e:
+                logger.exception("Failed to send email to %s: %s", first['email'], e)
+                success = False
+            tally.record_send(pending, success, time.perf_counter() - send_started)
+
+        if success and run_id is not None:
+            try:
+                for group_data in pending:
+                    await record_group_sent(pool, run_id, first['responsible_id'], group_data['plant_id'],
+                                            group_data['week'], [k['kpi_id'] for k in group_data['kpis']])
+            except Exception as e:
+                logger.warning("Email to %s sent but not recorded in ledger: %s", first['email'], e)
+
+    if batches:
+        logger.info("Processing %d email(s) for %d plant group(s)", len(batches), len(plant_groups))
+    await asyncio.gather(*(send_batch(groups) for groups in batches))
+    transport.flush()
+    timer.lap('send')
+
+    summary = {'run_id': run_id, **tally.summary(), 'kpis_updated': 0, 'completed': run_id is None}
+
+    if run_id is not None:
+        await execute(pool, SET_RUN_PHASE_SQL, ('update', False, False, run_id))
+        pending_updates = tally.kpis_to_update(
+            [row[0] for row in await fetch_all(pool, PENDING_KPI_UPDATES_SQL, (run_id, run_id))])
+        if pending_updates:
+            logger.info("Updating %d KPI(s) for next cycle", len(pending_updates))
+        results = await asyncio.gather(*(update_kpi_created_at(pool, kpi_id, run_id) for kpi_id in pending_updates))
+        summary['kpis_updated'] = sum(results)
+
+        run_completed = tally.completed(summary['kpis_updated'], pending_updates)
+        await execute(pool, SET_RUN_PHASE_SQL, ('done' if run_completed else 'update', run_completed, run_completed, run_id))
+        summary['completed'] = run_completed
+        timer.lap('update')
+
+    run_seconds = timer.finish()
+    summary['duration_seconds'] = round(run_seconds, 3)
+    summary['phases'] = {name: round(seconds, 3) for name, seconds in timer.phases.items()}
+    summary['send_p50_ms'] = _ms(percentile(tally.send_latencies, 50))
+    summary['send_p95_ms'] = _ms(percentile(tally.send_latencies, 95))
+
+    if run_id is not None:
+        try:
+            await execute(pool, INSERT_RUN_HISTORY_SQL, tally.history_params(
+                run_id, 'async-digest' if digest else 'async-per-plant', run_started_at, run_seconds, timer.phases,
+                summary['kpis_updated'], summary['completed'],
+            ))
+        except Exception as e:
+            logger.warning("Failed to record run history: %s", e)
+
+    logger.info("Task completed (run #%s)" if summary['completed'] else "Task incomplete (run #%s will resume)",
+                run_id, extra={key: value for key, value in summary.items() if key not in ('run_id', 'completed')})
+    return summary
+
+def _ms(seconds):
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+# ========================================
+# CLI
+# ========================================
+
+async def main_async(args):
+    if args.render_only:
+        transport = AsyncMailboxTransport(args.render_only)
+    else:
+        breaker = CircuitBreaker(SMTP_BREAKER_THRESHOLD, SMTP_BREAKER_RESET_SECONDS)
+        transport = AsyncSmtpTransport(SMTP_SERVER, SMTP_PORT, breaker)
+
+    pool = AsyncConnectionPool(
+        DB_CONNINFO,
+        kwargs={'password': DB_PASSWORD},
+        min_size=1,
+        max_size=args.db_pool_size,
+        open=False,
+    )
+    await pool.open()
+    try:
+        return await scheduled_email_task_async(pool, transport, args.concurrency, args.digest)
+    finally:
+        await pool.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the KPI email scheduler task once with asyncio I/O")
+    parser.add_argument('--concurrency', type=int, default=int(os.getenv('ASYNC_SEND_CONCURRENCY', 100)),
+                        help="maximum number of in-flight SMTP sends")
+    parser.add_argument('--db-pool-size', type=int, default=20, help="maximum Postgres connections")
+    parser.add_argument('--digest', action='store_true',
+                        default=os.getenv('EMAIL_DIGEST_MODE', 'false').lower() in ('1', 'true', 'yes'),
+                        help="one email per responsible across all their plants")
+    parser.add_argument('--render-only', default=os.getenv('EMAIL_RENDER_ONLY'),
+                        help="write messages to 'maildir:/path' or 'mbox:/path' instead of sending")
+    args = parser.parse_args()
+
+    setup_logging()
+    asyncio.run(main_async(args))
+
+if __name__ == '__main__':
+    main()
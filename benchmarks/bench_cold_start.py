@@ -0,0 +1,75 @@
+"""
+Cold-start benchmark for the Flask app.
+
+Starts a fresh interpreter per attempt, imports app.py, builds the app with
+create_app() (scheduler disabled) and serves one request through the test
+client, reporting the time spent in each step. No database is needed: the
+pool only opens on the first query.
+
+    python benchmarks/bench_cold_start.py
+    python benchmarks/bench_cold_start.py --repeat 10 --path /metrics --json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+flask_app = app.create_app(start_background_scheduler=False)
+created = time.perf_counter()
+response = flask_app.test_client().get(sys.argv[1])
+served = time.perf_counter()
+print(json.dumps({
+    'status': response.status_code,
+    'import_seconds': imported - started,
+    'create_app_seconds': created - imported,
+    'first_request_seconds': served - created,
+    'total_seconds': served - started,
+}))
+"""
+
+
+def run_once(path):
+    env = dict(os.environ, SCHEDULER_ENABLED='false', PROFILING_ENABLED='false', LOG_LEVEL='WARNING')
+    completed = subprocess.run([sys.executable, '-c', PROBE, path], cwd=ROOT, env=env,
+                               capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure app import, create_app() and first-request time")
+    parser.add_argument('--repeat', type=int, default=5, help="fresh interpreters to start")
+    parser.add_argument('--path', default='/', help="route for the first request (avoid ones that query the DB)")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+
+    samples = [run_once(args.path) for _ in range(args.repeat)]
+    steps = ['import_seconds', 'create_app_seconds', 'first_request_seconds', 'total_seconds']
+    result = {
+        'benchmark': 'cold_start',
+        'path': args.path,
+        'status': samples[-1]['status'],
+        'runs': args.repeat,
+        **{f"median_{step}": round(statistics.median(s[step] for s in samples), 4) for step in steps},
+    }
+
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print(f"🚀 Cold start to first request on {args.path} (HTTP {result['status']}), median of {args.repeat}:")
+        print(f"   Import app.py:  {result['median_import_seconds'] * 1000:.0f} ms")
+        print(f"   create_app():   {result['median_create_app_seconds'] * 1000:.0f} ms")
+        print(f"   First request:  {result['median_first_request_seconds'] * 1000:.0f} ms")
+        print(f"   ⚡ Total:        {result['median_total_seconds'] * 1000:.0f} ms")
+
+
+if __name__ == '__main__':
+    main()
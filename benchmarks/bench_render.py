@@ -0,0 +1,108 @@
+"""
+Offline benchmark for the email render pipeline.
+
+Renders reminder emails for a synthetic run of N plant groups (default 10k)
+and reports messages rendered per second, without touching the database or
+the SMTP relay.
+
+    python benchmarks/bench_render.py
+    python benchmarks/bench_render.py --groups 10000 --digest --sink mbox
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mailer import EmailRenderer, MailboxTransport  # noqa: E402
+from scheduling import batch_plant_groups, group_due_records, render_batch  # noqa: E402
+
+
+def synthetic_due_records(count, plants_per_responsible, kpis_per_group, seed):
+    """Rows shaped like get_due_kpis_with_responsibles() output, `count` plant groups worth"""
+    rng = random.Random(seed)
+    records = []
+    for index in range(count):
+        responsible_id = index // plants_per_responsible + 1
+        plant_id = index % plants_per_responsible + 1
+        for _ in range(kpis_per_group):
+            records.append((
+                rng.randint(1, 500), f"KPI {rng.randint(1, 500)}",
+                responsible_id, f"Responsible {responsible_id}", f"responsible{responsible_id}@example.com",
+                "2025-W45", f"Plant {plant_id}", plant_id,
+            ))
+    return records
+
+
+def render_all(renderer, due_records, digest, sink):
+    """Group, batch and render (and optionally write) every message like
+    scheduled_email_task does; returns the message count"""
+    batches = batch_plant_groups(group_due_records(due_records), digest)
+
+    for pending in batches:
+        msg = render_batch(renderer, pending)
+        if sink is None:
+            # Flatten like smtplib.send_message does so serialization is measured too
+            msg.as_bytes()
+        else:
+            sink.send(msg)
+
+    if sink is not None:
+        sink.flush()
+    return len(batches)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark KPI reminder email rendering")
+    parser.add_argument('--groups', type=int, default=10000, help="plant groups per synthetic run")
+    parser.add_argument('--plants-per-responsible', type=int, default=1)
+    parser.add_argument('--kpis-per-group', type=int, default=3)
+    parser.add_argument('--digest', action='store_true', help="coalesce plants into one email per responsible")
+    parser.add_argument('--sink', choices=['none', 'maildir', 'mbox'], default='none',
+                        help="also write messages to a temporary mailbox (render-only transport)")
+    parser.add_argument('--repeat', type=int, default=3, help="number of timed runs")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+
+    due_records = synthetic_due_records(args.groups, args.plants_per_responsible, args.kpis_per_group, args.seed)
+    renderer = EmailRenderer("administration.STS@avocarbon.com", "https://kpi-subsidy.azurewebsites.net")
+
+    timings = []
+    messages = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for attempt in range(args.repeat):
+            sink = None
+            if args.sink != 'none':
+                sink = MailboxTransport(args.sink, os.path.join(tmp, f"{args.sink}-{attempt}"))
+            started = time.perf_counter()
+            messages = render_all(renderer, due_records, args.digest, sink)
+            timings.append(time.perf_counter() - started)
+
+    best = min(timings)
+    result = {
+        'benchmark': 'render',
+        'groups': args.groups,
+        'messages': messages,
+        'digest': args.digest,
+        'sink': args.sink,
+        'runs_seconds': [round(t, 4) for t in timings],
+        'best_seconds': round(best, 4),
+        'messages_per_second': round(messages / best, 1),
+    }
+
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print(f"📝 Rendered {messages} message(s) for {args.groups} group(s) "
+              f"[digest={args.digest}, sink={args.sink}]")
+        print(f"   Runs: {', '.join(f'{t:.3f}s' for t in timings)}")
+        print(f"   ⚡ {result['messages_per_second']:.0f} messages/second (best run)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Compare two benchmark result files and flag regressions.
+
+Works on any of the JSON outputs in this directory (run_suite.py,
+bench_render.py --json, bench_cold_start.py --json). Only measurements are
+compared: the numeric leaves under "results" for run_suite.py, the top-level
+timing and throughput fields otherwise. Their name decides the direction:
+
+    *_ms, *_seconds             lower is better
+    *_per_second                higher is better
+    anything else (counts...)   reported, never flagged
+
+Everything else describes the run (fleet, environment, --groups, --path...)
+and must match between the two files; runs with a different fleet size or
+simulated SMTP latency are not comparable.
+
+Exits with status 1 when any metric is worse than the threshold, and with
+status 2 when the runs' setups differ (unless --allow-mismatch).
+
+    python benchmarks/compare.py baseline.json candidate.json
+    python benchmarks/compare.py baseline.json candidate.json --threshold 0.05 --json
+"""
+import argparse
+import json
+import sys
+
+
+def flatten(data, prefix=''):
+    """{'results': {'form': {'p95_ms': 3}}} -> {'results.form.p95_ms': 3}, numbers only"""
+    flat = {}
+    for key, value in data.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{path}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+# Describes when a run was made rather than what it ran
+VOLATILE_CONTEXT = {'created_at', 'fleet.current_week'}
+
+
+def direction(metric):
+    """-1 when lower is better, +1 when higher is better, 0 when not a performance metric"""
+    name = metric.rsplit('.', 1)[-1]
+    if name.endswith('_per_second'):
+        return 1
+    if name.endswith('_ms') or name.endswith('_seconds'):
+        return -1
+    return 0
+
+
+def split(data):
+    """(metrics, context) of a result file, both flattened"""
+    if 'results' in data:
+        metrics = flatten(data['results'], 'results.')
+        context = {key: value for key, value in data.items() if key != 'results'}
+    else:
+        metrics = {key: value for key, value in flatten(data).items() if direction(key) != 0}
+        context = {key: value for key, value in data.items() if key not in metrics and not isinstance(value, list)}
+    context = {key: value for key, value in flatten_all(context).items() if key not in VOLATILE_CONTEXT}
+    return metrics, context
+
+
+def flatten_all(data, prefix=''):
+    """Like flatten() but keeps every scalar, not just numbers"""
+    flat = {}
+    for key, value in data.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten_all(value, f"{path}."))
+        else:
+            flat[path] = value
+    return flat
+
+
+def mismatches(baseline, candidate):
+    """Setup fields (fleet, environment, parameters) that differ between the two files"""
+    base, cand = split(baseline)[1], split(candidate)[1]
+    return [(key, base.get(key), cand.get(key)) for key in sorted(base.keys() | cand.keys())
+            if base.get(key) != cand.get(key)]
+
+
+def compare(baseline, candidate, threshold):
+    """One row per metric present in both files"""
+    base, cand = split(baseline)[0], split(candidate)[0]
+    rows = []
+    for metric in sorted(base.keys() & cand.keys()):
+        old, new = base[metric], cand[metric]
+        sign = direction(metric)
+        change = (new - old) / old if old else 0.0
+        rows.append({
+            'metric': metric,
+            'baseline': old,
+            'candidate': new,
+            'change': round(change, 4),
+            'regression': sign != 0 and sign * change < -threshold,
+            'improvement': sign != 0 and sign * change > threshold,
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Flag regressions between two benchmark runs")
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=0.10, help="relative change tolerated (default 0.10 = 10%%)")
+    parser.add_argument('--all', action='store_true', help="also list unchanged and non-performance metrics")
+    parser.add_argument('--json', action='store_true', help="print the comparison as JSON")
+    parser.add_argument('--allow-mismatch', action='store_true',
+                        help="compare even if fleet, environment or parameters differ (warn only)")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    rows = compare(baseline, candidate, args.threshold)
+    regressions = [row for row in rows if row['regression']]
+    differences = mismatches(baseline, candidate)
+    for key, old, new in differences:
+        print(f"⚠️  {key} differs: {old!r} -> {new!r}", file=sys.stderr)
+
+    if args.json:
+        print(json.dumps({'threshold': args.threshold, 'regressions': len(regressions),
+                          'mismatches': [{'field': key, 'baseline': old, 'candidate': new} for key, old, new in differences],
+                          'metrics': rows}, indent=2, default=str))
+    else:
+        shown = rows if args.all else [row for row in rows if row['regression'] or row['improvement']]
+        width = max((len(row['metric']) for row in shown), default=0)
+        for row in shown:
+            marker = '❌' if row['regression'] else '✅' if row['improvement'] else '  '
+            print(f"{marker} {row['metric']:<{width}}  {row['baseline']:>12g} -> {row['candidate']:>12g}  {row['change']:+.1%}")
+        print(f"\n{len(regressions)} regression(s) beyond {args.threshold:.0%} across {len(rows)} compared metric(s)")
+
+    if differences and not args.allow_mismatch:
+        print(f"Runs are not comparable: {len(differences)} setup field(s) differ (--allow-mismatch to compare anyway)",
+              file=sys.stderr)
+        sys.exit(2)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Minimal local SMTP sink for benchmarks.
+
+Accepts every message and discards it, counting deliveries. An optional
+per-message delay stands in for relay latency. Speaks just enough SMTP for
+smtplib and aiosmtplib (HELO/EHLO, MAIL, RCPT, DATA, RSET, NOOP, QUIT).
+
+    python benchmarks/fake_smtp.py --port 2525 --latency-ms 50
+"""
+import argparse
+import socketserver
+import threading
+import time
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+
+    # Replies are small multi-line writes; with Nagle on, each waits for the
+    # client's delayed ACK and adds ~40 ms to every message
+    disable_nagle_algorithm = True
+
+    def _reply(self, text):
+        self.wfile.write(text.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self._reply('220 fake-smtp ready')
+        in_data = False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if in_data:
+                if line.rstrip(b'\r\n') == b'.':
+                    in_data = False
+                    if self.server.latency:
+                        time.sleep(self.server.latency)
+                    self.server.record_message()
+                    self._reply('250 OK queued')
+                continue
+
+            command = line[:4].upper()
+            if command == b'EHLO':
+                self._reply('250-fake-smtp')
+                self._reply('250-8BITMIME')
+                self._reply('250 SIZE 52428800')
+            elif command in (b'HELO', b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+                self._reply('250 OK')
+            elif command == b'DATA':
+                in_data = True
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+            elif command == b'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('502 Command not implemented')
+
+
+class FakeSmtpServer(socketserver.ThreadingTCPServer):
+    """Threaded SMTP sink; use as a context manager to run it in the background"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+    # The async scheduler opens up to --async-concurrency connections at once
+    request_queue_size = 1024
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        super().__init__((host, port), _SmtpHandler)
+        self.latency = latency
+        self.messages = 0
+        self._count_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def record_message(self):
+        with self._count_lock:
+            self.messages += 1
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-smtp', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local SMTP sink that accepts and discards mail")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2525)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="delay before acknowledging each message")
+    args = parser.parse_args()
+
+    with FakeSmtpServer(args.host, args.port, args.latency_ms / 1000) as server:
+        print(f"📮 Fake SMTP listening on {args.host}:{server.port} (Ctrl+C to stop)")
+        try:
+            while True:
+                time.sleep(5)
+                print(f"   {server.messages} message(s) received")
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env bash
+# Start two local Postgres instances, a primary and a streaming-replication
+# standby, to exercise DB_READ_HOST routing and read-your-writes.
+#
+#   benchmarks/local_replica.sh [BASE_DIR]          # default /tmp/kpi-pg
+#   REPLICA_DELAY=2s benchmarks/local_replica.sh    # make the standby lag on purpose
+#
+# Then point the app (or benchmarks/run_suite.py --dsn/--read-dsn) at them:
+#   DB_HOST=127.0.0.1 DB_PORT=5432 DB_NAME=kpi_bench DB_USER=postgres DB_SSLMODE=disable
+#   DB_READ_HOST=127.0.0.1 DB_READ_PORT=5433
+#
+# Stop with: pg_ctl -D BASE_DIR/replica stop && pg_ctl -D BASE_DIR/primary stop
+set -euo pipefail
+
+BASE=${1:-/tmp/kpi-pg}
+PRIMARY_PORT=${PRIMARY_PORT:-5432}
+REPLICA_PORT=${REPLICA_PORT:-5433}
+REPLICA_DELAY=${REPLICA_DELAY:-0}
+BIN=${PG_BIN:-$(pg_config --bindir)}
+
+if [ -e "$BASE/primary" ] || [ -e "$BASE/replica" ]; then
+    echo "$BASE already holds a cluster; remove it or pass another directory" >&2
+    exit 1
+fi
+mkdir -p "$BASE"
+
+# Primary: trust auth on localhost only, replication allowed by initdb's default pg_hba
+"$BIN/initdb" -D "$BASE/primary" -U postgres --auth=trust >/dev/null
+cat >> "$BASE/primary/postgresql.conf" <<CONF
+port = $PRIMARY_PORT
+listen_addresses = '127.0.0.1'
+wal_level = replica
+max_wal_senders = 4
+CONF
+"$BIN/pg_ctl" -D "$BASE/primary" -l "$BASE/primary.log" -w start
+"$BIN/createdb" -h 127.0.0.1 -p "$PRIMARY_PORT" -U postgres kpi_bench
+
+# Standby: base backup with -R writes standby.signal and primary_conninfo
+"$BIN/pg_basebackup" -h 127.0.0.1 -p "$PRIMARY_PORT" -U postgres -D "$BASE/replica" -R -X stream
+cat >> "$BASE/replica/postgresql.conf" <<CONF
+port = $REPLICA_PORT
+hot_standby = on
+recovery_min_apply_delay = '$REPLICA_DELAY'
+CONF
+"$BIN/pg_ctl" -D "$BASE/replica" -l "$BASE/replica.log" -w start
+
+"$BIN/psql" -h 127.0.0.1 -p "$PRIMARY_PORT" -U postgres -Atc \
+    "SELECT 'streaming to ' || client_addr || ' (' || state || ')' FROM pg_stat_replication"
+echo "primary: postgresql://postgres@127.0.0.1:$PRIMARY_PORT/kpi_bench"
+echo "replica: postgresql://postgres@127.0.0.1:$REPLICA_PORT/kpi_bench (apply delay $REPLICA_DELAY)"
@@ -0,0 +1,286 @@
+"""
+Reproducible benchmark suite against a seeded local Postgres and a fake SMTP sink.
+
+Seeds a synthetic fleet (see seed.py), starts fake_smtp.FakeSmtpServer, points
+the app at both through the environment and measures:
+
+    form            GET /form latency
+    submit          POST /submit throughput and latency
+    all_kpi_values  get_all_kpi_values()
+    due_kpis        get_due_kpis_with_responsibles()
+    scheduler       end-to-end scheduled_email_task()
+    scheduler_async end-to-end async_scheduler run
+
+With --read-dsn, read-only queries go to that replica (DB_READ_HOST routing);
+benchmarks/local_replica.sh starts a primary and a streaming standby to try it.
+
+Requests go through Flask's test client, so the numbers cover the app and the
+database but not a WSGI server. Results are written as JSON; compare two runs
+with benchmarks/compare.py.
+
+    python benchmarks/run_suite.py --dsn postgresql://postgres@127.0.0.1/kpi_bench --output results.json
+    python benchmarks/run_suite.py --only form,due_kpis --responsibles 2000
+
+Without a Postgres install, `pip install pgserver` ships one that listens on a
+Unix socket:
+
+    python -c "import pgserver; s = pgserver.get_server('/tmp/kpi_pg', cleanup_mode=None); s.psql('CREATE DATABASE kpi_bench')"
+    python benchmarks/run_suite.py --dsn "postgresql://postgres@/kpi_bench?host=/tmp/kpi_pg"
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+
+import psycopg2
+from psycopg2.extensions import parse_dsn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_smtp import FakeSmtpServer  # noqa: E402
+from seed import add_fleet_arguments, require_local, reset_scheduler_state, seed  # noqa: E402
+
+BENCHMARKS = ('form', 'submit', 'all_kpi_values', 'due_kpis', 'scheduler', 'scheduler_async')
+
+GROUPS_SQL = """
+    SELECT responsible_id, plant_id, week, array_agg(kpi_values_id ORDER BY kpi_values_id)
+    FROM public.kpi_values
+    GROUP BY responsible_id, plant_id, week
+"""
+
+
+def latency_stats(samples):
+    """Summary of a list of durations in seconds, reported in milliseconds"""
+    ordered = sorted(samples)
+
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'mean_ms': round(statistics.fmean(ordered) * 1000, 3),
+        'p50_ms': pct(50),
+        'p95_ms': pct(95),
+        'p99_ms': pct(99),
+        'max_ms': round(ordered[-1] * 1000, 3),
+    }
+
+
+def timed(fn, iterations, warmup):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def configure_app_env(dsn, smtp_port, digest, read_dsn=None):
+    """Point app.py / async_scheduler.py at the bench database and SMTP sink.
+    Every key is set explicitly so nothing falls back to the production .env."""
+    params = parse_dsn(dsn)
+    os.environ.update({
+        'DB_HOST': params.get('host', '127.0.0.1'),
+        'DB_PORT': params.get('port', '5432'),
+        'DB_NAME': params.get('dbname', ''),
+        'DB_USER': params.get('user', ''),
+        'DB_PASSWORD': params.get('password', ''),
+        'DB_SSLMODE': params.get('sslmode', 'disable'),
+        'EMAIL_HOST': '127.0.0.1',
+        'EMAIL_PORT': str(smtp_port),
+        'EMAIL_DIGEST_MODE': 'true' if digest else 'false',
+        'SCHEDULER_ENABLED': 'false',
+        'PROFILING_ENABLED': 'false',
+    })
+    os.environ.pop('EMAIL_RENDER_ONLY', None)
+    for key in ('DB_READ_HOST', 'DB_READ_PORT', 'DB_READ_USER', 'DB_READ_PASSWORD'):
+        os.environ.pop(key, None)
+    if read_dsn:
+        read = parse_dsn(read_dsn)
+        os.environ.update({
+            'DB_READ_HOST': read.get('host', '127.0.0.1'),
+            'DB_READ_PORT': read.get('port', '5432'),
+            'DB_READ_USER': read.get('user', params.get('user', '')),
+            'DB_READ_PASSWORD': read.get('password', params.get('password', '')),
+        })
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+
+def bench_form(client, groups, args, rng):
+    def request_one():
+        responsible_id, plant_id, week, _ = rng.choice(groups)
+        response = client.get(f"/form?responsible_id={responsible_id}&week={week}&plant_id={plant_id}")
+        assert response.status_code == 200, response.status_code
+        # form_page answers errors with a 200 page too, so make sure the form itself rendered
+        assert b'<form action="/submit"' in response.data, response.data[:200]
+
+    return latency_stats(timed(request_one, args.requests, args.warmup))
+
+
+def bench_submit(client, groups, args, rng):
+    def request_one():
+        responsible_id, plant_id, week, kpi_values_ids = rng.choice(groups)
+        form = {'responsible_id': responsible_id, 'week': week, 'plant_id': plant_id}
+        for kpi_values_id in kpi_values_ids:
+            form[f"analyse_{kpi_values_id}"] = f"bench analyse {rng.random():.6f}"
+            form[f"actions_{kpi_values_id}"] = "bench action"
+        response = client.post('/submit', data=form)
+        assert response.status_code == 200, response.status_code
+
+    samples = timed(request_one, args.requests, args.warmup)
+    result = latency_stats(samples)
+    result['requests_per_second'] = round(len(samples) / sum(samples), 1)
+    return result
+
+
+def bench_scheduler(app, conn, smtp, args):
+    durations, emails, runs = [], [], []
+    app.ensure_scheduler_tables()
+    for _ in range(args.scheduler_runs):
+        reset_scheduler_state(conn)
+        before = smtp.messages
+        started = time.perf_counter()
+        app.scheduled_email_task()
+        durations.append(time.perf_counter() - started)
+        emails.append(smtp.messages - before)
+        runs.extend(app.get_run_history(1))
+
+    result = {
+        'runs': len(durations),
+        'best_seconds': round(min(durations), 4),
+        'median_seconds': round(statistics.median(durations), 4),
+        'emails_sent': emails[-1],
+        'emails_per_second': round(emails[-1] / min(durations), 1) if emails[-1] else 0.0,
+    }
+    if runs:
+        last = runs[-1]
+        for phase in ('setup', 'query', 'group', 'send', 'update'):
+            result[f"{phase}_seconds"] = round(last[f"{phase}_seconds"] or 0.0, 4)
+        result['send_p95_ms'] = last['send_p95_ms']
+    return result
+
+
+def bench_scheduler_async(conn, smtp, args):
+    import async_scheduler
+
+    cli_args = argparse.Namespace(render_only=None, concurrency=args.async_concurrency,
+                                  db_pool_size=args.async_pool_size, digest=args.digest)
+    durations, emails = [], []
+    for _ in range(args.scheduler_runs):
+        reset_scheduler_state(conn)
+        before = smtp.messages
+        started = time.perf_counter()
+        asyncio.run(async_scheduler.main_async(cli_args))
+        durations.append(time.perf_counter() - started)
+        emails.append(smtp.messages - before)
+
+    return {
+        'runs': len(durations),
+        'concurrency': args.async_concurrency,
+        'best_seconds': round(min(durations), 4),
+        'median_seconds': round(statistics.median(durations), 4),
+        'emails_sent': emails[-1],
+        'emails_per_second': round(emails[-1] / min(durations), 1) if emails[-1] else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the KPI app benchmark suite")
+    add_fleet_arguments(parser)
+    parser.add_argument('--read-dsn', help="local streaming replica of --dsn for read-only queries")
+    parser.add_argument('--no-seed', action='store_true', help="reuse the data already in --dsn")
+    parser.add_argument('--only', help=f"comma-separated subset of: {', '.join(BENCHMARKS)}")
+    parser.add_argument('--requests', type=int, default=200, help="timed requests per HTTP benchmark")
+    parser.add_argument('--iterations', type=int, default=20, help="timed calls per query benchmark")
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--scheduler-runs', type=int, default=1)
+    parser.add_argument('--digest', action='store_true', help="run the scheduler in digest mode")
+    parser.add_argument('--async-concurrency', type=int, default=100)
+    parser.add_argument('--async-pool-size', type=int, default=20)
+    parser.add_argument('--smtp-latency-ms', type=float, default=0.0, help="simulated relay latency per message")
+    parser.add_argument('--output', help="write the JSON results to this file (default: stdout)")
+    args = parser.parse_args()
+
+    selected = args.only.split(',') if args.only else list(BENCHMARKS)
+    unknown = set(selected) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(sorted(unknown))}")
+
+    require_local(args.dsn, args.allow_remote)
+    if args.read_dsn:
+        require_local(args.read_dsn, args.allow_remote)
+    rng = random.Random(args.seed)
+    conn = psycopg2.connect(args.dsn)
+    # The app logs JSON lines to stdout; send them to stderr so stdout carries only the report
+    report_stream, sys.stdout = sys.stdout, sys.stderr
+
+    with FakeSmtpServer(latency=args.smtp_latency_ms / 1000) as smtp:
+        configure_app_env(args.dsn, smtp.port, args.digest, args.read_dsn)
+
+        if args.no_seed:
+            fleet = {'seeded': False}
+        else:
+            print("🌱 Seeding fleet...", file=sys.stderr)
+            fleet = seed(conn, args.plants, args.responsibles, args.kpis, args.weeks,
+                         args.plants_per_responsible, args.seed)
+
+        import app
+        client = app.create_app(start_background_scheduler=False).test_client()
+
+        with conn.cursor() as cur:
+            cur.execute(GROUPS_SQL)
+            groups = cur.fetchall()
+        conn.commit()
+
+        runners = {
+            'form': lambda: bench_form(client, groups, args, rng),
+            'submit': lambda: bench_submit(client, groups, args, rng),
+            'all_kpi_values': lambda: latency_stats(timed(app.get_all_kpi_values, args.iterations, args.warmup)),
+            'due_kpis': lambda: latency_stats(timed(app.get_due_kpis_with_responsibles, args.iterations, args.warmup)),
+            'scheduler': lambda: bench_scheduler(app, conn, smtp, args),
+            'scheduler_async': lambda: bench_scheduler_async(conn, smtp, args),
+        }
+
+        results = {}
+        for name in selected:
+            print(f"⏱️  {name}...", file=sys.stderr)
+            results[name] = runners[name]()
+        app.close_db_pool()
+
+    conn.close()
+
+    report = {
+        'suite': 'kpi-app',
+        'version': 1,
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'smtp_latency_ms': args.smtp_latency_ms,
+            'digest': args.digest,
+            'read_replica': bool(args.read_dsn),
+        },
+        'fleet': fleet,
+        'results': results,
+    }
+
+    output = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+        print(f"📝 Results written to {args.output}", file=sys.stderr)
+    else:
+        print(output, file=report_stream)
+
+
+if __name__ == '__main__':
+    main()
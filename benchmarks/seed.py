@@ -0,0 +1,182 @@
+"""
+Seed a local Postgres with a synthetic KPI fleet for benchmarks.
+
+Creates the tables the app reads (plants, "Responsible", "Kpi", kpi_values)
+if they are missing, empties them, and fills them with
+plants x responsibles x KPIs x weeks rows. Every KPI is due, and the newest
+seeded week is the current ISO week, so scheduled_email_task has a full
+run's worth of work.
+
+Only primary keys are created; add the production indexes by hand if you
+want them reflected in the numbers.
+
+    python benchmarks/seed.py --dsn postgresql://postgres@127.0.0.1/kpi_bench --responsibles 500
+"""
+import argparse
+import os
+import sys
+from datetime import date, timedelta
+
+import psycopg2
+from psycopg2.extensions import parse_dsn
+
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1', '')
+
+FLEET_TABLES_DDL = """
+    CREATE TABLE IF NOT EXISTS public.plants (
+        plant_id SERIAL PRIMARY KEY,
+        name TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS public."Responsible" (
+        responsible_id SERIAL PRIMARY KEY,
+        name TEXT NOT NULL,
+        email TEXT NOT NULL,
+        plant_id INTEGER REFERENCES public.plants (plant_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS public."Kpi" (
+        kpi_id SERIAL PRIMARY KEY,
+        "KPI_name" TEXT NOT NULL,
+        "KPI_objectif" TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        frequence_de_envoi TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+
+    CREATE TABLE IF NOT EXISTS public.kpi_values (
+        kpi_values_id SERIAL PRIMARY KEY,
+        kpi_id INTEGER NOT NULL REFERENCES public."Kpi" (kpi_id),
+        responsible_id INTEGER NOT NULL REFERENCES public."Responsible" (responsible_id),
+        plant_id INTEGER REFERENCES public.plants (plant_id),
+        week TEXT NOT NULL,
+        value NUMERIC,
+        "analyse" TEXT,
+        actions_correctives TEXT
+    );
+"""
+
+# Scheduler bookkeeping created by the app itself; emptied so every run starts clean
+SCHEDULER_TABLES = ('kpi_email_run_history', 'kpi_email_run_updates', 'kpi_email_ledger', 'kpi_email_runs')
+
+MAKE_KPIS_DUE_SQL = """
+    UPDATE public."Kpi"
+    SET created_at = NOW() - INTERVAL '7 days',
+        frequence_de_envoi = NOW() - INTERVAL '1 hour'
+"""
+
+
+def iso_weeks(count, today=None):
+    """The last `count` ISO weeks, oldest first, ending with the current one"""
+    today = today or date.today()
+    weeks = []
+    for offset in range(count - 1, -1, -1):
+        year, week, _ = (today - timedelta(weeks=offset)).isocalendar()
+        weeks.append(f"{year}-W{week:02d}")
+    return weeks
+
+
+def require_local(dsn, allow_remote=False):
+    """Refuse to seed anything but a local database unless explicitly allowed"""
+    host = parse_dsn(dsn).get('host', '')
+    if host not in LOCAL_HOSTS and not host.startswith('/') and not allow_remote:
+        sys.exit(f"Refusing to seed non-local host '{host}'; pass --allow-remote if this really is a scratch database")
+
+
+def reset_scheduler_state(conn):
+    """Make every KPI due again and forget previous scheduler runs"""
+    with conn.cursor() as cur:
+        cur.execute(MAKE_KPIS_DUE_SQL)
+        existing = []
+        for table in SCHEDULER_TABLES:
+            cur.execute("SELECT to_regclass(%s)", (f"public.{table}",))
+            if cur.fetchone()[0]:
+                existing.append(f"public.{table}")
+        if existing:
+            cur.execute(f"TRUNCATE {', '.join(existing)} RESTART IDENTITY")
+    conn.commit()
+
+
+def seed(conn, plants, responsibles, kpis, weeks, plants_per_responsible=1, seed_value=42):
+    """Replace the fleet tables' contents; returns row counts"""
+    week_list = iso_weeks(weeks)
+    plants_per_responsible = min(plants_per_responsible, plants)
+    with conn.cursor() as cur:
+        cur.execute(FLEET_TABLES_DDL)
+        cur.execute('TRUNCATE public.kpi_values, public."Kpi", public."Responsible", public.plants RESTART IDENTITY CASCADE')
+        cur.execute("SELECT setseed(%s)", ((seed_value % 1000) / 1000,))
+
+        cur.execute("INSERT INTO public.plants (name) SELECT 'Plant ' || i FROM generate_series(1, %s) i", (plants,))
+        cur.execute(
+            """
+            INSERT INTO public."Responsible" (name, email, plant_id)
+            SELECT 'Responsible ' || i, 'responsible' || i || '@example.com', (i - 1) %% %s + 1
+            FROM generate_series(1, %s) i
+            """,
+            (plants, responsibles),
+        )
+        cur.execute(
+            """
+            INSERT INTO public."Kpi" ("KPI_name", "KPI_objectif", created_at, frequence_de_envoi)
+            SELECT 'KPI ' || i, 'Objective ' || i, NOW() - INTERVAL '7 days', NOW() - INTERVAL '1 hour'
+            FROM generate_series(1, %s) i
+            """,
+            (kpis,),
+        )
+        # Each responsible reports on their home plant and the next plants_per_responsible - 1
+        cur.execute(
+            """
+            INSERT INTO public.kpi_values (kpi_id, responsible_id, plant_id, week, value)
+            SELECT k, r, (r - 1 + j) %% %s + 1, w, round((random() * 100)::numeric, 2)
+            FROM generate_series(1, %s) k,
+                 generate_series(1, %s) r,
+                 generate_series(0, %s) j,
+                 unnest(%s::text[]) w
+            """,
+            (plants, kpis, responsibles, plants_per_responsible - 1, week_list),
+        )
+        kpi_values = cur.rowcount
+    conn.commit()
+    reset_scheduler_state(conn)
+
+    return {
+        'plants': plants,
+        'responsibles': responsibles,
+        'kpis': kpis,
+        'weeks': weeks,
+        'plants_per_responsible': plants_per_responsible,
+        'kpi_values': kpi_values,
+        'due_groups': responsibles * plants_per_responsible,
+        'current_week': week_list[-1],
+    }
+
+
+def add_fleet_arguments(parser):
+    parser.add_argument('--dsn', default=os.getenv('BENCH_DATABASE_URL', 'postgresql://postgres@127.0.0.1:5432/kpi_bench'),
+                        help="local scratch database (env BENCH_DATABASE_URL)")
+    parser.add_argument('--allow-remote', action='store_true', help="allow a non-local --dsn")
+    parser.add_argument('--plants', type=int, default=20)
+    parser.add_argument('--responsibles', type=int, default=200)
+    parser.add_argument('--kpis', type=int, default=10)
+    parser.add_argument('--weeks', type=int, default=12)
+    parser.add_argument('--plants-per-responsible', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=42)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed a local Postgres with a synthetic KPI fleet")
+    add_fleet_arguments(parser)
+    args = parser.parse_args()
+
+    require_local(args.dsn, args.allow_remote)
+    conn = psycopg2.connect(args.dsn)
+    try:
+        fleet = seed(conn, args.plants, args.responsibles, args.kpis, args.weeks,
+                     args.plants_per_responsible, args.seed)
+    finally:
+        conn.close()
+    print(f"🌱 Seeded {fleet['kpi_values']} kpi_values rows "
+          f"({fleet['due_groups']} plant group(s) due for {fleet['current_week']}) into {parse_dsn(args.dsn).get('dbname')}")
+
+
+if __name__ == '__main__':
+    main()
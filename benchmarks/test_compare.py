@@ -0,0 +1,83 @@
+import pytest
+
+from compare import compare, direction, mismatches
+
+
+def suite(results, smtp_latency_ms=0.0, responsibles=200, created_at="2025-11-03T08:00:00+00:00"):
+    return {
+        'suite': 'kpi-app',
+        'created_at': created_at,
+        'environment': {'python': '3.11.7', 'smtp_latency_ms': smtp_latency_ms, 'digest': False},
+        'fleet': {'responsibles': responsibles, 'current_week': created_at[:10]},
+        'results': results,
+    }
+
+
+@pytest.mark.parametrize('metric, expected', [
+    ('results.form.p95_ms', -1),
+    ('results.scheduler.best_seconds', -1),
+    ('results.submit.requests_per_second', 1),
+    ('results.scheduler.emails_sent', 0),
+    ('results.form.count', 0),
+])
+def test_direction(metric, expected):
+    assert direction(metric) == expected
+
+
+def rows_by_metric(baseline, candidate, threshold=0.10):
+    return {row['metric']: row for row in compare(baseline, candidate, threshold)}
+
+
+def test_slower_latency_beyond_threshold_is_a_regression():
+    rows = rows_by_metric(suite({'form': {'p95_ms': 10.0}}), suite({'form': {'p95_ms': 11.5}}))
+    assert rows['results.form.p95_ms']['regression']
+    assert rows['results.form.p95_ms']['change'] == 0.15
+
+
+def test_change_within_threshold_is_not_flagged():
+    rows = rows_by_metric(suite({'form': {'p95_ms': 10.0}}), suite({'form': {'p95_ms': 10.5}}))
+    assert not rows['results.form.p95_ms']['regression']
+    assert not rows['results.form.p95_ms']['improvement']
+
+
+def test_lower_throughput_is_a_regression_and_higher_an_improvement():
+    rows = rows_by_metric(suite({'submit': {'requests_per_second': 400.0}}),
+                          suite({'submit': {'requests_per_second': 300.0}}))
+    assert rows['results.submit.requests_per_second']['regression']
+    rows = rows_by_metric(suite({'submit': {'requests_per_second': 300.0}}),
+                          suite({'submit': {'requests_per_second': 400.0}}))
+    assert rows['results.submit.requests_per_second']['improvement']
+
+
+def test_counts_are_reported_but_never_flagged():
+    rows = rows_by_metric(suite({'scheduler': {'emails_sent': 400}}), suite({'scheduler': {'emails_sent': 100}}))
+    assert not rows['results.scheduler.emails_sent']['regression']
+
+
+def test_only_results_are_compared():
+    rows = rows_by_metric(suite({}, smtp_latency_ms=0.0), suite({}, smtp_latency_ms=50.0))
+    assert rows == {}
+
+
+def test_differing_setup_is_a_mismatch():
+    assert mismatches(suite({}, smtp_latency_ms=0.0), suite({}, smtp_latency_ms=50.0)) == [
+        ('environment.smtp_latency_ms', 0.0, 50.0),
+    ]
+    assert mismatches(suite({}, responsibles=200), suite({}, responsibles=2000)) == [
+        ('fleet.responsibles', 200, 2000),
+    ]
+
+
+def test_run_date_is_not_a_mismatch():
+    assert mismatches(suite({}), suite({}, created_at="2025-11-10T08:00:00+00:00")) == []
+
+
+def test_flat_outputs_compare_timings_and_match_parameters():
+    baseline = {'benchmark': 'render', 'groups': 1000, 'runs_seconds': [0.5, 0.4], 'best_seconds': 0.4,
+                'messages_per_second': 2500.0}
+    candidate = dict(baseline, best_seconds=0.5, messages_per_second=2000.0, runs_seconds=[0.5])
+    rows = rows_by_metric(baseline, candidate)
+    assert set(rows) == {'best_seconds', 'messages_per_second'}
+    assert rows['best_seconds']['regression']
+    assert mismatches(baseline, candidate) == []
+    assert mismatches(baseline, dict(baseline, groups=2000)) == [('groups', 1000, 2000)]
@@ -0,0 +1,335 @@
+import logging
+import mailbox
+import smtplib
+import threading
+import time
+from email.mime.text import MIMEText
+from urllib.parse import quote_plus
+
+from metrics import SMTP_SENDS_TOTAL, observe_send
+
+logger = logging.getLogger(__name__)
+
+# ========================================
+# SMTP CIRCUIT BREAKER
+# ========================================
+
+class CircuitBreaker:
+    """
+    Circuit breaker around the SMTP relay.
+    Opens after `failure_threshold` consecutive connection failures; while open,
+    sends fail fast and one probe is let through every `reset_timeout` seconds.
+    A successful probe closes the circuit again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=3, reset_timeout=300, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._last_probe_at = None
+        self._last_error = None
+        self._rejected = 0
+
+    @property
+    def state(self):
+        return self._state
+
+    def allow(self):
+        """Return True if a send may be attempted now"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+
+            now = self._clock()
+            if now - self._last_probe_at >= self.reset_timeout:
+                # Let a single probe through; a probe that never reports back
+                # simply expires after another reset_timeout
+                self._state = self.HALF_OPEN
+                self._last_probe_at = now
+                return True
+
+            self._rejected += 1
+            return False
+
+    def record_success(self):
+        """The relay accepted a connection: close the circuit"""
+        with self._lock:
+            self._state = self.CLOSED
+            self._consecutive_failures = 0
+            self._opened_at = None
+            self._last_probe_at = None
+
+    def record_failure(self, error=None):
+        """The relay could not be reached: count it and open the circuit if needed"""
+        with self._lock:
+            self._consecutive_failures += 1
+            self._last_error = str(error) if error is not None else None
+            if self._state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                now = self._clock()
+                if self._opened_at is None:
+                    self._opened_at = time.time()
+                self._state = self.OPEN
+                self._last_probe_at = now
+
+    def retry_in(self):
+        """Seconds until the next probe is allowed (0 when closed)"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return 0
+            return max(0.0, self.reset_timeout - (self._clock() - self._last_probe_at))
+
+    def snapshot(self):
+        """Current breaker state as a dict for status pages"""
+        retry_in = self.retry_in()
+        with self._lock:
+            return {
+                'state': self._state,
+                'consecutive_failures': self._consecutive_failures,
+                'failure_threshold': self.failure_threshold,
+                'reset_timeout': self.reset_timeout,
+                'opened_at': self._opened_at,
+                'retry_in': retry_in,
+                'rejected': self._rejected,
+                'last_error': self._last_error,
+            }
+
+
+# ========================================
+# EMAIL TEMPLATES
+# ========================================
+
+# Plain f-strings: Python compiles them once with the function, and they are
+# the cheapest way to fill these templates
+
+
+def plant_email_html(responsible_name, week, plant_name, kpi_name, form_link):
+    return f"""
+        <!DOCTYPE html>
+        <html>
+        <body style="font-family:Arial,sans-serif; background:#f7f7f7; padding:24px;">
+          <div style="max-width:640px;margin:0 auto;background:#fff;border-radius:8px;overflow:hidden;border:1px solid #eee">
+            <div style="background:#0078D7;color:#fff;padding:20px 24px">
+              <h2 style="margin:0;font-weight:600">KPI Report – {responsible_name}</h2>
+              <div style="margin-top:8px;font-size:14px">Week {week} | {plant_name}</div>
+            </div>
+            <div style="padding:24px">
+              <p>Hello {responsible_name},</p>
+              <p>The KPI <strong>{kpi_name}</strong> for <strong>{plant_name}</strong> is due for reporting for week <strong>{week}</strong>.</p>
+              <p>Please click the link below to fill out your KPI analysis and corrective actions:</p>
+              <p style="text-align:center;margin:28px 0">
+                <a href="{form_link}"
+                   style="display:inline-block;padding:12px 20px;border-radius:6px;background:#0078D7;color:#fff;text-decoration:none;font-weight:600">
+                  Open KPI Form
+                </a>
+              </p>
+              <p style="font-size:12px;color:#666;margin-top:24px">
+                This is an automated reminder from the KPI tracking system.
+              </p>
+            </div>
+          </div>
+        </body>
+        </html>
+        """
+
+
+def digest_plant_html(plant_name, kpi_items, form_link):
+    return f"""
+              <div style="border:1px solid #e1e5e9;border-radius:6px;padding:16px;margin:16px 0">
+                <div style="font-weight:600;color:#0078D7">{plant_name}</div>
+                <ul style="margin:8px 0 12px 0;padding-left:20px">{kpi_items}</ul>
+                <a href="{form_link}"
+                   style="display:inline-block;padding:8px 16px;border-radius:6px;background:#0078D7;color:#fff;text-decoration:none;font-weight:600">
+                  Open KPI Form
+                </a>
+              </div>
+            """
+
+
+def digest_email_html(responsible_name, week, plant_count, plants_html):
+    return f"""
+        <!DOCTYPE html>
+        <html>
+        <body style="font-family:Arial,sans-serif; background:#f7f7f7; padding:24px;">
+          <div style="max-width:640px;margin:0 auto;background:#fff;border-radius:8px;overflow:hidden;border:1px solid #eee">
+            <div style="background:#0078D7;color:#fff;padding:20px 24px">
+              <h2 style="margin:0;font-weight:600">KPI Report – {responsible_name}</h2>
+              <div style="margin-top:8px;font-size:14px">Week {week} | {plant_count} plants</div>
+            </div>
+            <div style="padding:24px">
+              <p>Hello {responsible_name},</p>
+              <p>The following KPIs are due for reporting for week <strong>{week}</strong>.</p>
+              <p>Please open the form of each plant to fill out your KPI analysis and corrective actions:</p>
+              {plants_html}
+              <p style="font-size:12px;color:#666;margin-top:24px">
+                This is an automated reminder from the KPI tracking system.
+              </p>
+            </div>
+          </div>
+        </body>
+        </html>
+        """
+
+
+class EmailRenderer:
+    """
+    Render stage of the mail pipeline: turns KPI reminder data into ready-to-send
+    messages. Sender and base URL are resolved once per renderer, not per message.
+    """
+
+    def __init__(self, sender_address, base_url):
+        self.sender = f'"Administration STS" <{sender_address}>'
+        self.base_url = base_url.rstrip('/')
+
+    def form_link(self, responsible_id, week, plant_id):
+        return f"{self.base_url}/form?responsible_id={responsible_id}&week={quote_plus(week)}&plant_id={plant_id}"
+
+    def _message(self, to, subject, html_content):
+        msg = MIMEText(html_content, 'html', 'utf-8')
+        msg['From'] = self.sender
+        msg['To'] = to
+        msg['Subject'] = subject
+        return msg
+
+    def render_plant(self, responsible_id, responsible_name, responsible_email, kpi_name, week, plant_name, plant_id):
+        """Message for a single responsible and plant"""
+        html_content = plant_email_html(
+            responsible_name=responsible_name,
+            week=week,
+            plant_name=plant_name,
+            kpi_name=kpi_name,
+            form_link=self.form_link(responsible_id, week, plant_id),
+        )
+        return self._message(responsible_email, f"KPI Report - {kpi_name} - {plant_name} - Week {week}", html_content)
+
+    def render_digest(self, responsible_id, responsible_name, responsible_email, week, plant_groups):
+        """One message listing every due plant of a responsible with its own form link"""
+        plants_html = ''.join(
+            digest_plant_html(
+                plant_name=group['plant_name'],
+                kpi_items=''.join(f"<li>{kpi['kpi_name']}</li>" for kpi in group['kpis']),
+                form_link=self.form_link(responsible_id, week, group['plant_id']),
+            )
+            for group in plant_groups
+        )
+        html_content = digest_email_html(
+            responsible_name=responsible_name,
+            week=week,
+            plant_count=len(plant_groups),
+            plants_html=plants_html,
+        )
+        return self._message(responsible_email, f"KPI Report - {len(plant_groups)} plants - Week {week}", html_content)
+
+
+# ========================================
+# TRANSPORTS
+# ========================================
+
+class SmtpTransport:
+    """Delivers messages through the SMTP relay, guarded by a circuit breaker"""
+
+    render_only = False
+
+    # Failures that mean the relay could not be reached and count against the
+    # breaker; any other SMTP error means the relay answered and refused the
+    # message. Subclasses for other SMTP clients swap in their exception types.
+    UNREACHABLE_ERRORS = (smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected)
+    REFUSED_ERRORS = (smtplib.SMTPException,)
+
+    def __init__(self, host, port, breaker, timeout=10):
+        self.host = host
+        self.port = port
+        self.breaker = breaker
+        self.timeout = timeout
+
+    def allow(self):
+        if self.breaker.allow():
+            return True
+        SMTP_SENDS_TOTAL.labels(outcome='rejected').inc()
+        return False
+
+    def classify(self, error):
+        """'refused' when the relay answered and rejected the message, otherwise 'unreachable'"""
+        if isinstance(error, self.UNREACHABLE_ERRORS):
+            return 'unreachable'
+        if isinstance(error, self.REFUSED_ERRORS):
+            return 'refused'
+        # Socket-level failures: refused, timed out, DNS, network unreachable
+        return 'unreachable'
+
+    def record_outcome(self, outcome, recipient, started, error=None):
+        """Feed a send outcome to the circuit breaker and metrics; True when the message was sent"""
+        if outcome == 'unreachable':
+            self.breaker.record_failure(error)
+            logger.error("SMTP relay unreachable while sending to %s: %s", recipient, error)
+        else:
+            # The relay answered, so the transport is healthy even if this message was refused
+            self.breaker.record_success()
+            if outcome == 'refused':
+                logger.error("Failed to send email to %s: %s", recipient, error, exc_info=error)
+        observe_send(outcome, time.perf_counter() - started)
+        return outcome == 'sent'
+
+    def send(self, msg):
+        """Hand a message to the relay, feeding the outcome to the circuit breaker"""
+        started = time.perf_counter()
+        try:
+            with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as server:
+                server.send_message(msg)
+        except OSError as e:
+            # smtplib.SMTPException is an OSError too
+            return self.record_outcome(self.classify(e), msg['To'], started, e)
+        return self.record_outcome('sent', msg['To'], started)
+
+    def flush(self):
+        pass
+
+    def __str__(self):
+        return f"smtp://{self.host}:{self.port}"
+
+
+class MailboxTransport:
+    """Render-only transport: writes messages to a local maildir or mbox instead of sending"""
+
+    render_only = True
+
+    def __init__(self, kind, path):
+        if kind == 'maildir':
+            self.mailbox = mailbox.Maildir(path, create=True)
+        elif kind == 'mbox':
+            self.mailbox = mailbox.mbox(path, create=True)
+        else:
+            raise ValueError(f"Unknown mailbox kind '{kind}', expected 'maildir' or 'mbox'")
+        self.kind = kind
+        self.path = path
+        self._lock = threading.Lock()
+
+    def allow(self):
+        return True
+
+    def send(self, msg):
+        with self._lock:
+            self.mailbox.add(msg)
+        return True
+
+    def flush(self):
+        with self._lock:
+            self.mailbox.flush()
+
+    def __str__(self):
+        return f"{self.kind}:{self.path}"
+
+
+def mailbox_transport_from_spec(spec):
+    """Build a MailboxTransport from a 'maildir:/path' or 'mbox:/path' spec"""
+    kind, sep, path = spec.partition(':')
+    if not sep or not path:
+        raise ValueError(f"Invalid render-only spec '{spec}', expected 'maildir:/path' or 'mbox:/path'")
+    return MailboxTransport(kind, path)
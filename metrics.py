@@ -0,0 +1,122 @@
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Prometheus metrics shared by the Flask app, the mail transports and the
+# scheduler. Label values are bounded (route templates, fixed query names,
+# fixed outcomes and phases) so every series is created once and reused.
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'kpi_http_request_duration_seconds',
+    'Flask request latency by route template',
+    ['route', 'method', 'status'],
+)
+
+DB_QUERY_SECONDS = Histogram(
+    'kpi_db_query_duration_seconds',
+    'PostgreSQL query latency by named query',
+    ['query'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+
+SMTP_SEND_SECONDS = Histogram(
+    'kpi_smtp_send_duration_seconds',
+    'SMTP delivery latency by outcome',
+    ['outcome'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0, 30.0),
+)
+
+SMTP_SENDS_TOTAL = Counter(
+    'kpi_smtp_sends_total',
+    'SMTP send attempts by outcome (sent, refused, unreachable, rejected by the open circuit)',
+    ['outcome'],
+)
+
+SCHEDULER_PHASE_SECONDS = Histogram(
+    'kpi_scheduler_phase_duration_seconds',
+    'scheduled_email_task duration by phase (setup, query, group, send, update)',
+    ['phase'],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 1800.0, 3600.0),
+)
+
+SCHEDULER_RUN_SECONDS = Histogram(
+    'kpi_scheduler_run_duration_seconds',
+    'Total scheduled_email_task run duration',
+    buckets=(1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 1800.0, 3600.0),
+)
+
+APP_COLD_START_SECONDS = Gauge(
+    'kpi_app_cold_start_seconds',
+    'Seconds from importing app.py to the first served request',
+)
+
+
+@contextmanager
+def observe_query(name):
+    """Time a named database query into DB_QUERY_SECONDS"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        DB_QUERY_SECONDS.labels(query=name).observe(time.perf_counter() - started)
+
+
+def observe_send(outcome, seconds):
+    """Record one SMTP delivery attempt"""
+    SMTP_SEND_SECONDS.labels(outcome=outcome).observe(seconds)
+    SMTP_SENDS_TOTAL.labels(outcome=outcome).inc()
+
+
+class PhaseTimer:
+    """Collects per-phase durations of one scheduler run and exports them as histograms"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.phases = {}
+
+    def lap(self, name):
+        """Close the current phase: time since the previous lap is recorded as `name`"""
+        now = time.perf_counter()
+        elapsed = now - self._last
+        self._last = now
+        self.phases[name] = self.phases.get(name, 0.0) + elapsed
+        SCHEDULER_PHASE_SECONDS.labels(phase=name).observe(elapsed)
+
+    def finish(self):
+        """Record and return the total run duration"""
+        total = time.perf_counter() - self.started
+        SCHEDULER_RUN_SECONDS.observe(total)
+        return total
+
+
+class DbPoolCollector:
+    """Reports psycopg2 pool utilization at scrape time, so the hot path pays nothing.
+    `pools` maps a pool label (primary, replica) to a getter returning the pool or None."""
+
+    def __init__(self, pools):
+        self._pools = pools
+
+    def collect(self):
+        gauge = GaugeMetricFamily('kpi_db_pool_connections', 'PostgreSQL pool connections by pool and state',
+                                  labels=['pool', 'state'])
+        for name, get_pool in self._pools.items():
+            pool = get_pool()
+            if pool is not None:
+                gauge.add_metric([name, 'in_use'], len(pool._used))
+                gauge.add_metric([name, 'idle'], len(pool._pool))
+                gauge.add_metric([name, 'max'], pool.maxconn)
+        yield gauge
+
+
+class LogQueueCollector:
+    """Reports log records dropped on a full logging queue; `dropped` returns the running count"""
+
+    def __init__(self, dropped):
+        self._dropped = dropped
+
+    def collect(self):
+        yield CounterMetricFamily('kpi_log_records_dropped', 'Log records dropped because the logging queue was full',
+                                  value=self._dropped())
@@ -0,0 +1,184 @@
+import cProfile
+import hashlib
+import hmac
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# Opt-in deterministic profiling of a single request or a single scheduler run.
+# Nothing here is wired up unless PROFILING_ENABLED and PROFILING_SECRET are set,
+# so a disabled deployment registers no hooks and pays nothing per request.
+#
+# A profile is requested with a signed, short-lived token bound to its target
+# (the request path, or "scheduler" for the next scheduled run):
+#
+#     token = f"{ts}.{hmac_sha256(secret, f'{ts}:{target}')}"
+#
+# sent as the X-Profile-Token header. Generate one with
+#
+#     python profiling.py sign /form
+#
+# A token profiles exactly one request: its signature is remembered (per
+# process) until the token expires and a second use is ignored. The admin
+# pages trade a token for a short-lived session cookie instead of carrying
+# it in their links.
+#
+# Profiles are written as .pstats files, readable with `python -m pstats`,
+# snakeviz, or flameprof/gprof2dot for a flamegraph.
+#
+# Configuration (environment):
+#   PROFILING_ENABLED        "true" to enable
+#   PROFILING_SECRET         HMAC key for X-Profile-Token, required
+#   PROFILE_DIR              output directory, default ./profiles
+#   PROFILE_KEEP             newest profiles kept on disk, default 50
+#   PROFILE_TOKEN_MAX_AGE    token validity in seconds, default 300
+
+logger = logging.getLogger(__name__)
+
+TOKEN_HEADER = 'X-Profile-Token'
+SCHEDULER_TARGET = 'scheduler'
+ADMIN_SESSION_TARGET = 'admin-session'
+
+_UNSAFE_CHARS = re.compile(r'[^A-Za-z0-9_-]+')
+
+
+def sign_token(secret, target, ts=None):
+    """Token authorizing one profile of `target`, valid from `ts` (default now)"""
+    ts = int(time.time()) if ts is None else int(ts)
+    signature = hmac.new(secret.encode(), f"{ts}:{target}".encode(), hashlib.sha256).hexdigest()
+    return f"{ts}.{signature}"
+
+
+class Profiler:
+    """Verifies profile tokens and writes cProfile dumps to a local directory"""
+
+    def __init__(self, directory, secret, keep=50, max_age=300):
+        self.directory = directory
+        self._secret = secret
+        self.keep = keep
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._scheduler_armed = False
+        self._used_signatures = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def verify(self, token, target):
+        """True if `token` was signed for `target` within the last max_age seconds"""
+        if not token:
+            return False
+        ts, _, signature = token.partition('.')
+        if not ts.isdigit() or abs(time.time() - int(ts)) > self.max_age:
+            return False
+        expected = sign_token(self._secret, target, ts).partition('.')[2]
+        return hmac.compare_digest(signature, expected)
+
+    def consume(self, token, target):
+        """verify(), accepting each token only once until it expires"""
+        if not self.verify(token, target):
+            return False
+        ts, _, signature = token.partition('.')
+        now = time.time()
+        with self._lock:
+            self._used_signatures = {used: expires for used, expires in self._used_signatures.items() if expires >= now}
+            if signature in self._used_signatures:
+                return False
+            self._used_signatures[signature] = int(ts) + self.max_age
+        return True
+
+    def session_token(self):
+        """Token for the admin session cookie, valid for max_age seconds"""
+        return sign_token(self._secret, ADMIN_SESSION_TARGET)
+
+    def arm_scheduler(self):
+        """Profile the next scheduler run"""
+        with self._lock:
+            self._scheduler_armed = True
+
+    def take_scheduler_arm(self):
+        """Consume the arm flag; True if this run should be profiled"""
+        with self._lock:
+            armed, self._scheduler_armed = self._scheduler_armed, False
+            return armed
+
+    @property
+    def scheduler_armed(self):
+        return self._scheduler_armed
+
+    def new_profile_name(self, label):
+        slug = _UNSAFE_CHARS.sub('_', label).strip('_') or 'root'
+        return f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{slug}-{os.urandom(3).hex()}.pstats"
+
+    def start(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile, name):
+        """Stop `profile`, write it as `name` and prune old dumps; returns the file path"""
+        profile.disable()
+        path = os.path.join(self.directory, name)
+        profile.dump_stats(path)
+        self._prune()
+        return path
+
+    @contextmanager
+    def profile(self, label):
+        """Profile the enclosed block; yields the profile file name"""
+        name = self.new_profile_name(label)
+        profile = self.start()
+        try:
+            yield name
+        finally:
+            self.stop(profile, name)
+
+    def list_profiles(self, limit=50):
+        """Newest first: dicts with name, size and modified time"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.pstats'):
+                stat = entry.stat()
+                entries.append({'name': entry.name, 'size': stat.st_size,
+                                'modified': datetime.fromtimestamp(stat.st_mtime)})
+        entries.sort(key=lambda item: item['modified'], reverse=True)
+        return entries[:limit]
+
+    def _prune(self):
+        for stale in self.list_profiles(limit=None)[self.keep:]:
+            try:
+                os.remove(os.path.join(self.directory, stale['name']))
+            except OSError:
+                pass
+
+
+def profiler_from_env():
+    """Profiler configured from the environment, or None when profiling is off"""
+    if os.getenv('PROFILING_ENABLED', 'false').lower() not in ('1', 'true', 'yes'):
+        return None
+    secret = os.getenv('PROFILING_SECRET')
+    if not secret:
+        logger.warning("PROFILING_ENABLED is set but PROFILING_SECRET is empty, profiling stays off")
+        return None
+    return Profiler(
+        os.getenv('PROFILE_DIR', 'profiles'),
+        secret,
+        keep=int(os.getenv('PROFILE_KEEP', 50)),
+        max_age=int(os.getenv('PROFILE_TOKEN_MAX_AGE', 300)),
+    )
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate an X-Profile-Token header value")
+    parser.add_argument('command', choices=['sign'])
+    parser.add_argument('target', help=f"request path (e.g. /form) or '{SCHEDULER_TARGET}'")
+    args = parser.parse_args()
+
+    secret = os.getenv('PROFILING_SECRET')
+    if not secret:
+        parser.error("PROFILING_SECRET is not set")
+    print(sign_token(secret, args.target))
@@ -0,0 +1,346 @@
+import math
+from datetime import datetime
+
+# Shared, side-effect-free pieces of the KPI email scheduler: the SQL, the
+# grouping logic and the per-run send decisions used by both the threaded run
+# (app.py) and the asyncio run (async_scheduler.py), which only do the I/O.
+# Placeholders use %s, understood by psycopg2 and psycopg 3.
+
+# Arbitrary application-wide key for pg_try_advisory_lock so only one
+# scheduled_email_task runs at a time across threads, workers and instances.
+SCHEDULER_LOCK_KEY = 7424731
+
+# ========================================
+# SQL
+# ========================================
+
+SCHEDULER_TABLES_DDL = """
+    CREATE TABLE IF NOT EXISTS public.kpi_email_runs (
+        run_id SERIAL PRIMARY KEY,
+        week TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        phase TEXT NOT NULL DEFAULT 'send',
+        groups_done INTEGER NOT NULL DEFAULT 0,
+        started_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        checkpoint_at TIMESTAMPTZ,
+        finished_at TIMESTAMPTZ
+    );
+
+    CREATE TABLE IF NOT EXISTS public.kpi_email_ledger (
+        run_id INTEGER NOT NULL REFERENCES public.kpi_email_runs (run_id),
+        responsible_id INTEGER NOT NULL,
+        plant_id INTEGER,
+        week TEXT NOT NULL,
+        kpi_ids INTEGER[] NOT NULL,
+        sent_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+
+    CREATE UNIQUE INDEX IF NOT EXISTS kpi_email_ledger_key
+        ON public.kpi_email_ledger (responsible_id, (COALESCE(plant_id, -1)), week, run_id);
+
+    CREATE TABLE IF NOT EXISTS public.kpi_email_run_updates (
+        run_id INTEGER NOT NULL REFERENCES public.kpi_email_runs (run_id),
+        kpi_id INTEGER NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (run_id, kpi_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS public.kpi_email_run_history (
+        history_id SERIAL PRIMARY KEY,
+        run_id INTEGER NOT NULL REFERENCES public.kpi_email_runs (run_id),
+        mode TEXT NOT NULL,
+        started_at TIMESTAMPTZ NOT NULL,
+        duration_seconds DOUBLE PRECISION NOT NULL,
+        setup_seconds DOUBLE PRECISION,
+        query_seconds DOUBLE PRECISION,
+        group_seconds DOUBLE PRECISION,
+        send_seconds DOUBLE PRECISION,
+        update_seconds DOUBLE PRECISION,
+        groups_processed INTEGER NOT NULL,
+        emails_sent INTEGER NOT NULL,
+        emails_failed INTEGER NOT NULL,
+        groups_deferred INTEGER NOT NULL,
+        kpis_updated INTEGER NOT NULL,
+        send_p50_ms DOUBLE PRECISION,
+        send_p95_ms DOUBLE PRECISION,
+        completed BOOLEAN NOT NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS kpi_email_run_history_started
+        ON public.kpi_email_run_history (started_at DESC);
+"""
+
+TRY_LOCK_SQL = "SELECT pg_try_advisory_lock(%s)"
+
+UNLOCK_SQL = "SELECT pg_advisory_unlock(%s)"
+
+# Only the newest unfinished run may be resumed, and only while it is
+# recent (see start_or_resume_run); older ones are closed as stale
+UNFINISHED_RUNS_SQL = """
+    SELECT run_id, week, groups_done, started_at >= NOW() - make_interval(hours => %s) AS recent
+    FROM public.kpi_email_runs
+    WHERE status NOT IN ('completed', 'abandoned')
+    ORDER BY run_id DESC
+"""
+
+CLOSE_STALE_RUN_SQL = """
+    UPDATE public.kpi_email_runs
+    SET status = 'abandoned', checkpoint_at = NOW(), finished_at = NOW()
+    WHERE run_id = %s
+"""
+
+INSERT_RUN_SQL = "INSERT INTO public.kpi_email_runs (week) VALUES (%s) RETURNING run_id"
+
+SENT_GROUPS_SQL = """
+    SELECT responsible_id, plant_id, week
+    FROM public.kpi_email_ledger
+    WHERE run_id = %s
+"""
+
+INSERT_LEDGER_SQL = """
+    INSERT INTO public.kpi_email_ledger (run_id, responsible_id, plant_id, week, kpi_ids)
+    VALUES (%s, %s, %s, %s, %s)
+    ON CONFLICT (responsible_id, (COALESCE(plant_id, -1)), week, run_id) DO NOTHING
+"""
+
+ADVANCE_CHECKPOINT_SQL = """
+    UPDATE public.kpi_email_runs
+    SET groups_done = groups_done + %s, checkpoint_at = NOW()
+    WHERE run_id = %s
+"""
+
+PENDING_KPI_UPDATES_SQL = """
+    SELECT DISTINCT unnest(kpi_ids) AS kpi_id
+    FROM public.kpi_email_ledger
+    WHERE run_id = %s
+    EXCEPT
+    SELECT kpi_id FROM public.kpi_email_run_updates WHERE run_id = %s
+    ORDER BY kpi_id
+"""
+
+SET_RUN_PHASE_SQL = """
+    UPDATE public.kpi_email_runs
+    SET phase = %s,
+        checkpoint_at = NOW(),
+        status = CASE WHEN %s THEN 'completed' ELSE status END,
+        finished_at = CASE WHEN %s THEN NOW() ELSE finished_at END
+    WHERE run_id = %s
+"""
+
+INSERT_RUN_HISTORY_SQL = """
+    INSERT INTO public.kpi_email_run_history (
+        run_id, mode, started_at, duration_seconds,
+        setup_seconds, query_seconds, group_seconds, send_seconds, update_seconds,
+        groups_processed, emails_sent, emails_failed, groups_deferred, kpis_updated,
+        send_p50_ms, send_p95_ms, completed
+    )
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+RECENT_RUN_HISTORY_SQL = """
+    SELECT run_id, mode, started_at, duration_seconds,
+           setup_seconds, query_seconds, group_seconds, send_seconds, update_seconds,
+           groups_processed, emails_sent, emails_failed, groups_deferred, kpis_updated,
+           send_p50_ms, send_p95_ms, completed
+    FROM public.kpi_email_run_history
+    ORDER BY started_at DESC
+    LIMIT %s
+"""
+
+DUE_KPIS_SQL = """
+    SELECT DISTINCT
+        k.kpi_id,
+        k."KPI_name",
+        r.responsible_id,
+        r.name,
+        r.email,
+        kv.week,
+        COALESCE(p.name, 'N/A') as plant_name,
+        kv.plant_id
+    FROM public."Kpi" k
+    JOIN public.kpi_values kv ON kv.kpi_id = k.kpi_id
+    JOIN public."Responsible" r ON r.responsible_id = kv.responsible_id
+    LEFT JOIN public.plants p ON kv.plant_id = p.plant_id
+    WHERE k.frequence_de_envoi <= NOW()
+      AND kv.week = %s
+    ORDER BY kv.plant_id, k.kpi_id, r.responsible_id
+"""
+
+UPDATE_KPI_CREATED_AT_SQL = """
+    UPDATE public."Kpi"
+    SET created_at = NOW()
+    WHERE kpi_id = %s
+    RETURNING kpi_id, "KPI_name", created_at, frequence_de_envoi
+"""
+
+RECORD_KPI_UPDATE_SQL = """
+    INSERT INTO public.kpi_email_run_updates (run_id, kpi_id)
+    VALUES (%s, %s)
+    ON CONFLICT DO NOTHING
+"""
+
+# ========================================
+# HELPERS
+# ========================================
+
+def resumable_run(unfinished_runs, week):
+    """
+    The run to resume from UNFINISHED_RUNS_SQL rows: the newest one, if it is
+    for `week` and recent. Returns (run, stale_runs).
+    """
+    if unfinished_runs:
+        newest = unfinished_runs[0]
+        if newest[1] == week and newest[3]:
+            return newest, list(unfinished_runs[1:])
+    return None, list(unfinished_runs)
+
+def get_current_iso_week():
+    """Get current ISO week in format YYYY-Wxx (e.g., 2025-W43)"""
+    now = datetime.now()
+    iso_calendar = now.isocalendar()
+    return f"{iso_calendar[0]}-W{iso_calendar[1]:02d}"
+
+def group_due_records(due_records):
+    """Group due rows by (responsible_id, plant_id) to send one email per plant"""
+    plant_groups = {}
+    for kpi_id, kpi_name, responsible_id, resp_name, email, week, plant_name, plant_id in due_records:
+        key = (responsible_id, plant_id)
+        if key not in plant_groups:
+            plant_groups[key] = {
+                'responsible_id': responsible_id,
+                'resp_name': resp_name,
+                'email': email,
+                'week': week,
+                'plant_name': plant_name,
+                'plant_id': plant_id,
+                'kpis': []
+            }
+        plant_groups[key]['kpis'].append({
+            'kpi_id': kpi_id,
+            'kpi_name': kpi_name
+        })
+    return plant_groups
+
+def batch_plant_groups(plant_groups, digest):
+    """One batch (email) per plant group, or per responsible in digest mode"""
+    batches = {}
+    for (responsible_id, plant_id), group_data in plant_groups.items():
+        batch_key = responsible_id if digest else (responsible_id, plant_id)
+        batches.setdefault(batch_key, []).append(group_data)
+    return list(batches.values())
+
+def summary_kpi_name(kpis):
+    """Use the first KPI name for the email subject (or you could list all)"""
+    kpi_name = kpis[0]['kpi_name']
+    if len(kpis) > 1:
+        kpi_name = f"{kpi_name} and {len(kpis)-1} more"
+    return kpi_name
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers, None when empty"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+def run_history_params(run_id, mode, started_at, duration, phases, groups_processed, emails_sent,
+                       emails_failed, groups_deferred, kpis_updated, send_latencies, completed):
+    """Parameters for INSERT_RUN_HISTORY_SQL; durations and send latencies are in seconds"""
+    p50 = percentile(send_latencies, 50)
+    p95 = percentile(send_latencies, 95)
+    return (
+        run_id, mode, started_at, duration,
+        phases.get('setup'), phases.get('query'), phases.get('group'), phases.get('send'), phases.get('update'),
+        groups_processed, emails_sent, emails_failed, groups_deferred, kpis_updated,
+        p50 * 1000 if p50 is not None else None,
+        p95 * 1000 if p95 is not None else None,
+        completed,
+    )
+
+def render_batch(renderer, pending):
+    """The message for a batch: a plant email for a single group, a digest otherwise"""
+    first = pending[0]
+    if len(pending) == 1:
+        return renderer.render_plant(first['responsible_id'], first['resp_name'], first['email'],
+                                     summary_kpi_name(first['kpis']), first['week'],
+                                     first['plant_name'], first['plant_id'])
+    return renderer.render_digest(first['responsible_id'], first['resp_name'], first['email'],
+                                  first['week'], pending)
+
+def batch_kpi_ids(pending):
+    """Every KPI id covered by a batch"""
+    return [kpi['kpi_id'] for group in pending for kpi in group['kpis']]
+
+# ========================================
+# RUN BOOKKEEPING
+# ========================================
+
+class RunTally:
+    """
+    Send-phase state of one scheduler run: which groups of a batch still need
+    an email, what was deferred while the SMTP circuit was open, the counters
+    for the run history, and whether the update phase may close the run.
+    """
+
+    def __init__(self, plant_groups, sent_groups=()):
+        self.plant_groups = plant_groups
+        self.sent_groups = set(sent_groups)
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        self.deferred = 0
+        self.kpis_processed = set()
+        self.kpis_deferred = set()
+        self.send_latencies = []
+
+    def pending(self, groups):
+        """Groups of a batch not yet recorded in the ledger for this run; the rest count as skipped"""
+        pending = [group for group in groups
+                   if (group['responsible_id'], group['plant_id'], group['week']) not in self.sent_groups]
+        self.skipped += len(groups) - len(pending)
+        return pending
+
+    def defer(self, pending):
+        """The SMTP circuit is open: the groups and their KPIs wait for a later run"""
+        self.deferred += len(pending)
+        self.kpis_deferred.update(batch_kpi_ids(pending))
+
+    def record_send(self, pending, success, seconds):
+        """Count a send attempt and its latency; a sent batch marks its KPIs as emailed"""
+        self.send_latencies.append(seconds)
+        if success:
+            self.sent += 1
+            self.kpis_processed.update(batch_kpi_ids(pending))
+        else:
+            self.failed += 1
+
+    @property
+    def groups_processed(self):
+        return len(self.plant_groups) - self.skipped
+
+    def kpis_to_update(self, pending_kpi_ids):
+        """
+        KPIs to bump for the next cycle, from the ledger so KPIs emailed before a
+        restart are still bumped exactly once. KPIs that still have a deferred
+        group stay due so the resumed run can email them.
+        """
+        return [kpi_id for kpi_id in pending_kpi_ids if kpi_id not in self.kpis_deferred]
+
+    def completed(self, kpis_updated, kpis_to_update):
+        """Leave the run open if any update failed or any group was deferred so the next run retries it"""
+        return kpis_updated == len(kpis_to_update) and not self.deferred
+
+    def history_params(self, run_id, mode, started_at, duration, phases, kpis_updated, completed):
+        return run_history_params(run_id, mode, started_at, duration, phases, self.groups_processed,
+                                  self.sent, self.failed, self.deferred, kpis_updated, self.send_latencies,
+                                  completed)
+
+    def summary(self):
+        return {
+            'emails_sent': self.sent,
+            'emails_failed': self.failed,
+            'groups_skipped': self.skipped,
+            'groups_deferred': self.deferred,
+            'kpis_emailed': len(self.kpis_processed),
+        }
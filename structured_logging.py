@@ -0,0 +1,140 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import sys
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# Non-blocking structured logging. Callers only format the record and put it on
+# a bounded in-memory queue; a background QueueListener thread does the actual
+# stdout writes, so a slow or back-pressured stdout never holds up a request or
+# the scheduler. Records are emitted as one JSON object per line, tagged with
+# the current request id and scheduler run id.
+#
+# Configuration (environment):
+#   LOG_LEVEL       root level, default INFO
+#   LOG_LEVELS      per-logger overrides, e.g. "app=DEBUG,werkzeug=WARNING"
+#   LOG_FORMAT      "json" (default) or "text"
+#   LOG_QUEUE_SIZE  max queued records before new ones are dropped, default 10000
+
+request_id_var = ContextVar('request_id', default=None)
+run_id_var = ContextVar('run_id', default=None)
+
+# Attributes every LogRecord has; anything else was passed through `extra=`
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id', 'run_id'}
+
+_listener = None
+_handler = None
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+class ContextFilter(logging.Filter):
+    """Stamps records with the request and run ids of the emitting context"""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        record.run_id = run_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: ts, level, logger, msg, ids, extra fields, exc"""
+
+    def format(self, record):
+        payload = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if getattr(record, 'request_id', None):
+            payload['request_id'] = record.request_id
+        if getattr(record, 'run_id', None) is not None:
+            payload['run_id'] = record.run_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                payload[key] = value
+        if record.exc_info:
+            payload['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload['exc'] = record.exc_text
+        return json.dumps(payload, default=str, ensure_ascii=False)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that never blocks the caller: when the queue is full the record is dropped"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._exc_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        # Resolve args and tracebacks here, while they are still valid, but leave
+        # the final formatting to the listener thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging():
+    """Route all logging through the background writer; safe to call more than once"""
+    global _listener, _handler
+    if _listener is not None:
+        return
+
+    log_queue = queue.Queue(int(os.getenv('LOG_QUEUE_SIZE', 10000)))
+    _handler = NonBlockingQueueHandler(log_queue)
+    _handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [_handler]
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    for spec in os.getenv('LOG_LEVELS', '').split(','):
+        name, _, level = spec.partition('=')
+        if name.strip() and level.strip():
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+    stream = logging.StreamHandler(sys.stdout)
+    if os.getenv('LOG_FORMAT', 'json').lower() == 'text':
+        stream.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s [%(request_id)s %(run_id)s] %(message)s'))
+    else:
+        stream.setFormatter(JsonFormatter())
+
+    _listener = QueueListener(log_queue, stream)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Flush queued records and stop the background writer"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+        if dropped_records():
+            # The writer is stopped, so report straight to stderr
+            sys.stderr.write(f"{dropped_records()} log record(s) dropped: logging queue full (LOG_QUEUE_SIZE)\n")
+
+
+def dropped_records():
+    """Number of records dropped because the queue was full"""
+    return _handler.dropped if _handler is not None else 0
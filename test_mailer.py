@@ -0,0 +1,102 @@
+import smtplib
+
+import pytest
+
+from mailer import CircuitBreaker, SmtpTransport
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def breaker(clock):
+    return CircuitBreaker(failure_threshold=3, reset_timeout=60, clock=clock)
+
+
+def test_breaker_stays_closed_below_threshold(breaker):
+    breaker.record_failure(OSError("refused"))
+    breaker.record_failure(OSError("refused"))
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_success_resets_consecutive_failures(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_opens_at_threshold_and_fails_fast(breaker):
+    for _ in range(3):
+        breaker.record_failure(OSError("refused"))
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    assert not breaker.allow()
+    snapshot = breaker.snapshot()
+    assert snapshot['rejected'] == 2
+    assert snapshot['last_error'] == "refused"
+    assert snapshot['retry_in'] == 60
+
+
+def test_open_breaker_lets_one_probe_through_after_reset_timeout(breaker, clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 59
+    assert not breaker.allow()
+    assert breaker.retry_in() == pytest.approx(1)
+
+    clock.now += 1
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # Only one probe per reset_timeout
+    assert not breaker.allow()
+
+
+def test_failed_probe_reopens_the_circuit(breaker, clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 60
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    clock.now += 60
+    assert breaker.allow()
+
+
+def test_successful_probe_closes_the_circuit(breaker, clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 60
+    assert breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.retry_in() == 0
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+@pytest.mark.parametrize('error, outcome', [
+    (smtplib.SMTPConnectError(421, b"busy"), 'unreachable'),
+    (smtplib.SMTPServerDisconnected("gone"), 'unreachable'),
+    (ConnectionRefusedError("refused"), 'unreachable'),
+    (TimeoutError("timed out"), 'unreachable'),
+    (smtplib.SMTPRecipientsRefused({}), 'refused'),
+    (smtplib.SMTPDataError(554, b"rejected"), 'refused'),
+])
+def test_smtp_errors_map_to_outcomes(breaker, error, outcome):
+    assert SmtpTransport('relay', 25, breaker).classify(error) == outcome
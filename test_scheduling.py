@@ -0,0 +1,124 @@
+import pytest
+
+from scheduling import RunTally, batch_plant_groups, group_due_records, percentile, resumable_run, summary_kpi_name
+
+
+def due(kpi_id, responsible_id, plant_id, week="2025-W45"):
+    return (kpi_id, f"KPI {kpi_id}", responsible_id, f"Responsible {responsible_id}",
+            f"r{responsible_id}@example.com", week, f"Plant {plant_id}", plant_id)
+
+
+# ---------- resumable_run ----------
+# Rows are (run_id, week, groups_done, recent), newest first
+
+def test_no_unfinished_runs():
+    assert resumable_run([], "2025-W45") == (None, [])
+
+
+def test_recent_same_week_run_is_resumed():
+    run, stale = resumable_run([(7, "2025-W45", 12, True)], "2025-W45")
+    assert run == (7, "2025-W45", 12, True)
+    assert stale == []
+
+
+def test_older_unfinished_runs_are_stale_behind_the_resumed_one():
+    rows = [(9, "2025-W45", 3, True), (8, "2025-W45", 0, False), (5, "2025-W44", 40, False)]
+    run, stale = resumable_run(rows, "2025-W45")
+    assert run[0] == 9
+    assert [row[0] for row in stale] == [8, 5]
+
+
+@pytest.mark.parametrize('row', [
+    (7, "2025-W44", 12, True),   # previous week, even if recent
+    (7, "2025-W45", 12, False),  # this week, but too old
+])
+def test_run_from_another_week_or_too_old_is_stale(row):
+    assert resumable_run([row], "2025-W45") == (None, [row])
+
+
+# ---------- percentile ----------
+
+def test_percentile_of_nothing_is_none():
+    assert percentile([], 95) is None
+
+
+def test_percentile_of_one_value():
+    assert percentile([0.2], 50) == 0.2
+    assert percentile([0.2], 99) == 0.2
+
+
+def test_percentile_uses_nearest_rank():
+    values = [4, 1, 3, 2]
+    assert percentile(values, 50) == 2
+    assert percentile(values, 51) == 3
+    assert percentile(values, 100) == 4
+    assert percentile(values, 0) == 1
+
+
+def test_p95_of_twenty_values():
+    values = list(range(1, 21))
+    assert percentile(values, 95) == 19
+    assert percentile(values, 96) == 20
+
+
+# ---------- grouping and batching ----------
+
+def test_due_records_group_by_responsible_and_plant():
+    groups = group_due_records([due(1, 10, 1), due(2, 10, 1), due(1, 10, 2)])
+    assert list(groups) == [(10, 1), (10, 2)]
+    assert [kpi['kpi_id'] for kpi in groups[(10, 1)]['kpis']] == [1, 2]
+
+
+def test_one_batch_per_plant_without_digest():
+    groups = group_due_records([due(1, 10, 1), due(1, 10, 2), due(1, 11, 1)])
+    batches = batch_plant_groups(groups, digest=False)
+    assert [[(g['responsible_id'], g['plant_id']) for g in batch] for batch in batches] == [
+        [(10, 1)], [(10, 2)], [(11, 1)],
+    ]
+
+
+def test_digest_batches_all_plants_of_a_responsible():
+    groups = group_due_records([due(1, 10, 1), due(1, 11, 1), due(2, 10, 2)])
+    batches = batch_plant_groups(groups, digest=True)
+    assert [[(g['responsible_id'], g['plant_id']) for g in batch] for batch in batches] == [
+        [(10, 1), (10, 2)], [(11, 1)],
+    ]
+
+
+def test_summary_kpi_name():
+    assert summary_kpi_name([{'kpi_name': "Scrap"}]) == "Scrap"
+    assert summary_kpi_name([{'kpi_name': "Scrap"}, {'kpi_name': "OEE"}, {'kpi_name': "OTD"}]) == "Scrap and 2 more"
+
+
+# ---------- RunTally ----------
+
+def test_groups_already_in_the_ledger_are_skipped():
+    groups = group_due_records([due(1, 10, 1), due(1, 10, 2)])
+    tally = RunTally(groups, {(10, 1, "2025-W45")})
+    batch = batch_plant_groups(groups, digest=True)[0]
+
+    pending = tally.pending(batch)
+    assert [group['plant_id'] for group in pending] == [2]
+    assert tally.skipped == 1
+    assert tally.groups_processed == 1
+
+
+def test_deferred_kpis_stay_due_and_keep_the_run_open():
+    groups = group_due_records([due(1, 10, 1), due(2, 11, 1)])
+    tally = RunTally(groups)
+    sent, deferred = batch_plant_groups(groups, digest=False)
+
+    tally.record_send(tally.pending(sent), True, 0.01)
+    tally.defer(tally.pending(deferred))
+
+    assert tally.kpis_to_update([1, 2]) == [1]
+    assert not tally.completed(1, [1])
+    assert tally.summary() == {
+        'emails_sent': 1, 'emails_failed': 0, 'groups_skipped': 0, 'groups_deferred': 1, 'kpis_emailed': 1,
+    }
+
+
+def test_run_completes_only_when_every_update_succeeded():
+    tally = RunTally({})
+    assert tally.completed(2, [1, 2])
+    assert not tally.completed(1, [1, 2])